@@ -9,22 +9,37 @@ WhatsApp Travel Assistant – Flask + Twilio + OpenAI (GPT-5) + SQLite + ICS + C
 - אחסון קבצים בדיסק מתמשך (/data) ברנדר.
 """
 
-import os, re, uuid, sqlite3, logging, json, mimetypes, hashlib
+import os, re, uuid, sqlite3, logging, json, mimetypes, time, threading, random, shutil, functools
 from datetime import datetime, timedelta
+from calendar import monthrange
 from urllib.parse import urlparse
-from collections import defaultdict
-from typing import List, Dict, Optional, Tuple
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
+from typing import Iterator, List, Dict, Optional, Tuple
 
+import orjson
+import xxhash
 import requests
-from flask import Flask, request, abort, send_file, jsonify, g, Response, redirect
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request, abort, send_file, jsonify, g, Response, redirect, stream_with_context, copy_current_request_context
 from werkzeug.utils import secure_filename
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.request_validator import RequestValidator
 from twilio.rest import Client as TwilioClient
+from twilio.http.http_client import TwilioHttpClient
 
 # OpenAI
+import httpx
 from openai import OpenAI
 import openai
+try:
+    import h2  # noqa: F401  (httpx[http2])
+    _OPENAI_HTTP2 = True
+except ImportError:
+    _OPENAI_HTTP2 = False
 
 # Google Calendar OAuth
 from google_auth_oauthlib.flow import Flow
@@ -43,12 +58,23 @@ logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(message
 logger = logging.getLogger(__name__)
 
 TZ = os.getenv("TZ", "UTC")
+_TZ = None
+if ZoneInfo:
+    try:
+        _TZ = ZoneInfo(TZ)
+    except Exception:
+        _TZ = None
+_TZ_STRFMT = f"%Y-%m-%d %H:%M {TZ}"
 
 VERIFY_TWILIO_SIGNATURE = os.getenv("VERIFY_TWILIO_SIGNATURE", "false").lower() == "true"
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM")
 TWILIO_MESSAGING_SERVICE_SID = os.getenv("TWILIO_MESSAGING_SERVICE_SID")
+# הודעות יזומות (send_whatsapp) דורשות שולח; בלעדיו אפשר לענות רק ב-TwiML
+TWILIO_CAN_SEND = bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and (TWILIO_MESSAGING_SERVICE_SID or TWILIO_WHATSAPP_FROM))
+TWILIO_HTTP_TIMEOUT = float(os.getenv("TWILIO_HTTP_TIMEOUT", "10"))
+TWILIO_MAX_MPS = float(os.getenv("TWILIO_MAX_MPS", "10"))   # תקרת הודעות יוצאות לשנייה (כל ה-threads יחד)
 
 BASE_PUBLIC_URL = os.getenv("BASE_PUBLIC_URL")
 CRON_SECRET = os.getenv("CRON_SECRET", "changeme")
@@ -65,9 +91,51 @@ for pair in (os.getenv("CONTACT_ALIASES","").split(",") if os.getenv("CONTACT_AL
         name, wa = pair.split("=", 1)
         CONTACT_ALIASES[name.strip()] = wa.strip()
 
+# ───────────────────────────── HTTP משותף ─────────────────────────────
+RETRY_AFTER_MAX = 10.0   # שניות; Retry-After של השרת לא יקפיא thread לזמן בלתי מוגבל
+
+class _JitterRetry(Retry):
+    """Exponential backoff spread by random jitter, so parallel fetches don't retry in lockstep."""
+    def get_backoff_time(self) -> float:
+        return super().get_backoff_time() * random.uniform(1.0, 2.0)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, RETRY_AFTER_MAX)
+
+# Session אחד עם keep-alive ו-retry לכל הקריאות היוצאות (מדיה של Twilio, aviationstack)
+HTTP = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=20, pool_maxsize=50,
+    # raise_on_status=False: כשה-retries נגמרים מקבלים את התשובה האחרונה (429/5xx) ולא RetryError
+    max_retries=_JitterRetry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                             raise_on_status=False),
+)
+HTTP.mount("https://", _http_adapter)
+HTTP.mount("http://", _http_adapter)
+
+# לקריאות מתוך ה-webhook (Twilio מוותר אחרי 15 שניות): בלי retry ועם timeout קצר
+HTTP_INTERACTIVE = requests.Session()
+_http_interactive_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0)
+HTTP_INTERACTIVE.mount("https://", _http_interactive_adapter)
+HTTP_INTERACTIVE.mount("http://", _http_interactive_adapter)
+INTERACTIVE_TIMEOUT = (3.05, 8)
+
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS)
+# עבודות ארוכות שרצות אחרי שה-webhook כבר ענה; pool נפרד כי הן עצמן ממתינות למשימות ב-EXECUTOR
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "4"))
+BACKGROUND = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
+
 # ───────────────────────────── OpenAI (GPT-5) ─────────────────────────────
 api_key = os.getenv("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=api_key) if api_key else None
+# לקוח httpx אחד לכל התהליך: keep-alive + HTTP/2 (אם h2 מותקן) במקום handshake לכל קריאה
+OPENAI_HTTP = httpx.Client(
+    http2=_OPENAI_HTTP2,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    timeout=httpx.Timeout(25.0, connect=5.0),
+)
+openai_client = OpenAI(api_key=api_key, http_client=OPENAI_HTTP) if api_key else None
 
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5")
 OPENAI_VERBOSITY = os.getenv("OPENAI_VERBOSITY")                 # optional: low|medium|high
@@ -82,7 +150,8 @@ def _gpt5_extra() -> dict:
         extra["reasoning_effort"] = OPENAI_REASONING_EFFORT
     return extra
 
-def gpt_chat(messages: List[dict], temperature: Optional[float] = None, timeout: int = 25):
+def gpt_chat(messages: List[dict], temperature: Optional[float] = None, timeout: int = 25,
+             response_format: Optional[dict] = None):
     """Call Chat Completions robustly; GPT-5 ignores temperature (use default)."""
     if not openai_client:
         raise RuntimeError("OpenAI client not configured")
@@ -91,6 +160,8 @@ def gpt_chat(messages: List[dict], temperature: Optional[float] = None, timeout:
     base_kwargs = {"model": OPENAI_MODEL, "messages": messages, "timeout": timeout}
     if (not is_gpt5) and (temperature is not None):
         base_kwargs["temperature"] = temperature
+    if response_format:
+        base_kwargs["response_format"] = response_format
 
     extra = _gpt5_extra()
     try:
@@ -113,26 +184,23 @@ SYSTEM_PROMPT = os.getenv(
     "You are a concise, helpful WhatsApp assistant. Answer in the user's language."
 )
 
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+CHAT_HISTORY_TURNS = 8
+CHAT_HISTORY_MAX_USERS = int(os.getenv("CHAT_HISTORY_MAX_USERS", "10000"))
+
 def build_messages(history: List[dict], user_text: str) -> List[dict]:
-    sys_prompt = globals().get("SYSTEM_PROMPT") or os.getenv(
-        "SYSTEM_PROMPT",
-        "You are a concise, helpful WhatsApp assistant. Answer in the user's language."
-    )
-    trimmed = history[-8:] if len(history) > 8 else history[:]
-    msgs = [{"role": "system", "content": sys_prompt}]
-    msgs.extend(trimmed)
-    msgs.append({"role": "user", "content": user_text})
-    return msgs
+    return [SYSTEM_MSG, *list(history)[-CHAT_HISTORY_TURNS:], {"role": "user", "content": user_text}]
 
 # ───────────────────────────── עזרי זמן/טלפון ─────────────────────────────
 def tz_now():
-    if ZoneInfo:
-        try:
-            return datetime.now(ZoneInfo(TZ))
-        except Exception:
-            pass
+    if _TZ:
+        return datetime.now(_TZ)
     return datetime.utcnow()
 
+def date_str(d: datetime) -> str:
+    # YYYY-MM-DD בלי strftime (איטי ותלוי locale)
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d}"
+
 def normalize_waid(s: Optional[str]) -> Optional[str]:
     if not s:
         return s
@@ -144,10 +212,40 @@ def normalize_waid(s: Optional[str]) -> Optional[str]:
 
 # ───────────────────────────── Flask/Twilio ─────────────────────────────
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_MB", "25")) * 1024 * 1024
 
-twilio_client: Optional[TwilioClient] = None
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+@functools.lru_cache(maxsize=1)
+def get_twilio_client() -> Optional[TwilioClient]:
+    """Built on first outbound send (not at import), once per worker process; None without credentials."""
+    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
+        return None
+    # Session אחד עם keep-alive; ה-pool בגודל ה-EXECUTOR כדי ששליחות מקבילות לא יפתחו חיבורי TLS חדשים
+    http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_HTTP_TIMEOUT)
+    http_client.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(IO_WORKERS, 10)))
+    return TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
+
+class _TokenBucket:
+    """Token bucket thread-safe; acquire() חוסם עד שמתפנה טוקן."""
+    def __init__(self, rate: float):
+        self.rate = max(rate, 0.1)
+        self.capacity = max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_twilio_bucket = _TokenBucket(TWILIO_MAX_MPS)
 
 # ───────────────────────────── אחסון ודיסק ─────────────────────────────
 DATA_ROOT = os.getenv("DATA_ROOT") or "/data"
@@ -167,17 +265,54 @@ os.makedirs(STORAGE_DIR, exist_ok=True)
 
 DB_PATH = os.getenv("DB_PATH") or os.path.join(DATA_ROOT, "data.sqlite3")
 
+DB_WRITE_RETRIES = 5
+DB_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "cache_size=-20000", "busy_timeout=30000")
+
+# חיבור SQLite אחד לכל thread, נשמר בין בקשות (autocommit; טרנזקציות מפורשות ב-db_write)
+_db_local = threading.local()
+
+def _open_db() -> sqlite3.Connection:
+    db = sqlite3.connect(DB_PATH, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        db.execute(f"PRAGMA {pragma}")
+    return db
+
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        db = getattr(_db_local, "db", None)
+        if db is None or _db_local.pid != os.getpid():
+            db = _open_db()
+            _db_local.db, _db_local.pid = db, os.getpid()
+        g.db = db
     return g.db
 
+def db_write(fn):
+    """Run fn(db) inside BEGIN IMMEDIATE; retry with backoff while SQLite reports 'database is locked'."""
+    db = get_db()
+    for attempt in range(DB_WRITE_RETRIES):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            result = fn(db)
+            db.execute("COMMIT")
+            return result
+        except sqlite3.OperationalError as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            if "locked" not in str(e) or attempt == DB_WRITE_RETRIES - 1:
+                raise
+            time.sleep(0.05 * (2 ** attempt))
+        except Exception:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+
 @app.teardown_appcontext
-def close_db(_):
+def close_db(exc):
+    # החיבור נשאר פתוח; רק סוגרים טרנזקציה שנשארה פתוחה
     db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        db.execute("ROLLBACK" if exc else "COMMIT")
 
 def init_db():
     db = get_db()
@@ -260,6 +395,7 @@ def init_db():
             provider TEXT DEFAULT 'aviationstack',
             last_snapshot TEXT,
             last_hash TEXT,
+            snapshot_hash INTEGER,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             updated_at TEXT DEFAULT CURRENT_TIMESTAMP
         );
@@ -276,17 +412,45 @@ def init_db():
             source_file_id TEXT,
             created_at TEXT
         );
-     
+
+        CREATE TABLE IF NOT EXISTS chat_history (
+            waid TEXT PRIMARY KEY,
+            messages TEXT,
+            updated_at TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS cron_runs (
+            job TEXT NOT NULL,
+            run_key TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (job, run_key)
+        );
+
+        DROP INDEX IF EXISTS idx_flights_waid_date;
+        DROP INDEX IF EXISTS idx_fw_waid;
+        CREATE INDEX IF NOT EXISTS idx_flights_waid_date_time ON flights(waid, depart_date, depart_time);
+        CREATE INDEX IF NOT EXISTS idx_flights_date ON flights(depart_date);
+        CREATE INDEX IF NOT EXISTS idx_hotels_waid_date ON hotels(waid, checkin_date);
+        CREATE INDEX IF NOT EXISTS idx_hotels_checkin ON hotels(checkin_date);
+        CREATE INDEX IF NOT EXISTS idx_files_waid ON files(waid, uploaded_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_recs_waid_city ON recs(waid, city_tag);
+        CREATE INDEX IF NOT EXISTS idx_fw_waid_flight ON flight_watch(waid, flight_iata);
+        CREATE INDEX IF NOT EXISTS idx_fw_flight ON flight_watch(flight_iata, flight_date);
+        CREATE INDEX IF NOT EXISTS idx_chat_history_updated ON chat_history(updated_at);
+
+        PRAGMA optimize;
     """)
     # מיגרציה מתונה (idempotent)
     try:
         db.execute("ALTER TABLE flights ADD COLUMN passenger_name TEXT")
     except sqlite3.OperationalError:
         pass
-    db.commit()
+    try:
+        db.execute("ALTER TABLE flight_watch ADD COLUMN snapshot_hash INTEGER")
+    except sqlite3.OperationalError:
+        pass
 def save_passport_record(waid: str, source_file_id: str, p: dict):
-    db = get_db()
-    db.execute(
+    db_write(lambda db: db.execute(
         """INSERT INTO passports
            (id, waid, full_name, passport_number, nationality, birth_date, issue_date, expiry_date, mrz, source_file_id, created_at)
            VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
@@ -300,41 +464,75 @@ def save_passport_record(waid: str, source_file_id: str, p: dict):
          (p.get("mrz") or None),
          source_file_id,
          datetime.utcnow().isoformat())
-    )
-    db.commit()
+    ))
 
 with app.app_context():
     init_db()
 
 # ───────────────────────────── כלי עזר ─────────────────────────────
 TWILIO_SAFE_CHUNK = 1500
-chat_histories: Dict[str, List[dict]] = defaultdict(list)
 
-def chunk_text(s: str, n: int = TWILIO_SAFE_CHUNK) -> List[str]:
+# היסטוריית שיחה
+def load_chat_history(waid: str) -> deque:
+    """History lives in SQLite so all gunicorn workers share it; only the turns build_messages uses are kept."""
+    row = get_db().execute("SELECT messages FROM chat_history WHERE waid=?", (waid,)).fetchone()
+    msgs = json.loads(row["messages"]) if row and row["messages"] else []
+    return deque(msgs, maxlen=CHAT_HISTORY_TURNS)
+
+def save_chat_history(waid: str, history: deque):
+    msgs = json.dumps(list(history), ensure_ascii=False); now = datetime.utcnow().isoformat()
+    def _save(db):
+        if db.execute("UPDATE chat_history SET messages=?, updated_at=? WHERE waid=?", (msgs, now, waid)).rowcount:
+            return
+        # משתמש חדש: מוסיפים שורה ומפנים את הישנים ביותר מעבר לתקרה (LRU לפי updated_at)
+        db.execute("INSERT INTO chat_history (waid, messages, updated_at) VALUES (?,?,?)", (waid, msgs, now))
+        db.execute(
+            "DELETE FROM chat_history WHERE waid IN "
+            "(SELECT waid FROM chat_history ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (CHAT_HISTORY_MAX_USERS,)
+        )
+    db_write(_save)
+
+def chunk_text(s: str, n: int = TWILIO_SAFE_CHUNK) -> Iterator[str]:
+    """Yield slices of at most n chars, preferring to cut at a newline (which is dropped at the cut)."""
     s = s or ""
-    return [s[i:i+n] for i in range(0, len(s), n)] or [""]
+    if not s:
+        yield ""
+        return
+    i, L = 0, len(s)
+    while i < L:
+        j = min(i + n, L)
+        k = s.rfind("\n", i + 200, j) if j < L else -1
+        if k != -1:
+            yield s[i:k]; i = k + 1
+        else:
+            yield s[i:j]; i = j
 
 def public_base_url() -> str:
     if BASE_PUBLIC_URL:
         return BASE_PUBLIC_URL.rstrip("/") + "/"
     return request.host_url
 
+@functools.lru_cache(maxsize=1)
+def _twilio_validator() -> RequestValidator:
+    return RequestValidator(TWILIO_AUTH_TOKEN)
+
 def _validated_twilio_request() -> bool:
     if not VERIFY_TWILIO_SIGNATURE:
         return True
     if not TWILIO_AUTH_TOKEN:
         logger.warning("VERIFY_TWILIO_SIGNATURE=true אבל חסר TWILIO_AUTH_TOKEN")
         return False
-    validator = RequestValidator(TWILIO_AUTH_TOKEN)
     url = request.url
     xf_proto = request.headers.get("X-Forwarded-Proto", "")
     if xf_proto == "https" and url.startswith("http://"):
         url = "https://" + url[len("http://"):]
     signature = request.headers.get("X-Twilio-Signature", "")
-    form = request.form.to_dict(flat=True)
-    return validator.validate(url, form, signature)
+    # ה-validator קורא את ה-MultiDict ישירות (getlist), בלי להעתיק את כל הטופס ל-dict
+    return _twilio_validator().validate(url, request.form, signature)
 
 def send_whatsapp(to_waid: str, body: str, media_urls: Optional[List[str]] = None):
+    twilio_client = get_twilio_client()
     if not twilio_client:
         logger.warning("Twilio client not configured; cannot send outbound.")
         return
@@ -346,11 +544,16 @@ def send_whatsapp(to_waid: str, body: str, media_urls: Optional[List[str]] = Non
         kwargs["from_"] = TWILIO_WHATSAPP_FROM
     if media_urls:
         kwargs["media_url"] = media_urls
+    _twilio_bucket.acquire()
     try:
         twilio_client.messages.create(**kwargs)
     except Exception as e:
         logger.exception("Twilio send failed: %s", e)
 
+def send_whatsapp_many(items: List[Tuple[str, str]]) -> None:
+    """Send (waid, body) pairs concurrently on EXECUTOR; send_whatsapp rate-limits each call."""
+    list(EXECUTOR.map(lambda item: send_whatsapp(*item), items))
+
 # ───────────────────────────── פירוק טקסט בסיסי ─────────────────────────────
 CITY_MAP = {
     "בנגקוק": "BKK", "bangkok": "BKK",
@@ -365,65 +568,83 @@ DATE_PATTERNS = [
     (re.compile(r"(\d{1,2})[./-](\d{1,2})[./-](\d{4})"), "%d-%m-%Y"),
 ]
 TIME_RGX = re.compile(r"\b(\d{1,2}):(\d{2})\b")
+IATA_RGX = re.compile(r"\b[A-Z]{3}\b")
+FLIGHT_NO_RGX = re.compile(r"\b(?:[A-Z]{2}|[A-Z]\d|\d[A-Z])\s?\d{1,4}\b")
+# חיפוש עיר בסריקה אחת (מפתחות ארוכים קודם כדי ש"קוסמוי" ינצח את "סמוי")
+CITY_RGX = re.compile("|".join(re.escape(k) for k in sorted(CITY_MAP, key=len, reverse=True)), re.IGNORECASE)
 
 def parse_dates(text: str) -> List[str]:
-    out = []
+    out, seen = [], set()
     for rgx, fmt in DATE_PATTERNS:
         for m in rgx.finditer(text or ""):
-            try:
-                if fmt == "%Y-%m-%d":
-                    y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
-                else:
-                    d, mo, y = int(m.group(1)), int(m.group(2)), int(m.group(3))
-                dt_ = datetime(y, mo, d)
-                out.append(dt_.strftime("%Y-%m-%d"))
-            except Exception:
-                continue
-    return list(dict.fromkeys(out))
+            if fmt == "%Y-%m-%d":
+                y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+            else:
+                d, mo, y = int(m.group(1)), int(m.group(2)), int(m.group(3))
+            if 1 <= mo <= 12 and 1 <= y and 1 <= d <= monthrange(y, mo)[1]:
+                ymd = f"{y:04d}-{mo:02d}-{d:02d}"
+                if ymd not in seen:
+                    seen.add(ymd); out.append(ymd)
+    return out
 
 def parse_times(text: str) -> List[str]:
-    res = []
+    res, seen = [], set()
     for m in TIME_RGX.finditer(text or ""):
         h, mi = int(m.group(1)), int(m.group(2))
         if 0 <= h <= 23 and 0 <= mi <= 59:
-            res.append(f"{h:02d}:{mi:02d}")
-    return list(dict.fromkeys(res))
+            hm = f"{h:02d}:{mi:02d}"
+            if hm not in seen:
+                seen.add(hm); res.append(hm)
+    return res
 
 def detect_airports(text: str) -> Dict[str, Optional[str]]:
-    t = (text or "").lower()
     origin, dest = None, None
-    iatas = re.findall(r"\b[A-Z]{3}\b", text or "")
+    iatas = IATA_RGX.findall(text or "")
     if len(iatas) >= 2:
         origin, dest = iatas[0], iatas[1]
     else:
-        for name, code in CITY_MAP.items():
-            if name in t and code in ("BKK","HKT","CNX","USM","KBV","TLV"):
-                if not origin: origin = code
-                elif not dest and code != origin: dest = code
+        # לפי סדר ההופעה בטקסט ("מתל אביב לפוקט" → TLV→HKT)
+        for m in CITY_RGX.finditer(text or ""):
+            code = CITY_MAP[m.group(0).lower()]
+            if not origin: origin = code
+            elif code != origin:
+                dest = code
+                break
     if dest and not origin:
         origin = "TLV"
     return {"origin": origin, "dest": dest}
 
 # ───────────────────────────── AI חילוץ פרטים ─────────────────────────────
+# הודעות system קבועות – נבנות פעם אחת בטעינת המודול
+EXTRACT_BOOKING_MSG = {"role": "system", "content": (
+    "Extract flight and hotel details from booking text.\n"
+    "Return STRICT JSON:\n"
+    "{ flights: [ {origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr,passengers} ],"
+    "  hotels:  [ {hotel_name,city,checkin_date,checkout_date,address} ] }\n"
+    "Where 'passengers' is an array of full names (['JOHN DOE']).\n"
+    "Dates in YYYY-MM-DD, times HH:MM 24h. Fill only known fields. If nothing, return empty arrays."
+)}
+EXTRACT_PASSPORT_MSG = {"role": "system", "content": (
+    "You are reading a passport photo. Return STRICT JSON with keys: "
+    "{ full_name, passport_number, nationality, birth_date, issue_date, expiry_date, mrz }. "
+    "Dates in YYYY-MM-DD when possible; unknown fields as null. No extra text."
+)}
+EXTRACT_BOOKING_IMAGE_MSG = {"role": "system", "content": (
+    "You read images of flight tickets and hotel confirmations and return STRICT JSON as: "
+    "{ flights:[{origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr,passengers}],"
+    "  hotels:[{hotel_name,city,checkin_date,checkout_date,address}] } (YYYY-MM-DD, HH:MM)."
+)}
+
 def ai_extract_booking_from_text(text: str) -> Dict[str, list]:
     if not openai_client:
         return {"flights": [], "hotels": []}
-    prompt = (
-        "Extract flight and hotel details from booking text.\n"
-        "Return STRICT JSON:\n"
-        "{ flights: [ {origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr,passengers} ],"
-        "  hotels:  [ {hotel_name,city,checkin_date,checkout_date,address} ] }\n"
-        "Where 'passengers' is an array of full names (['JOHN DOE']).\n"
-        "Dates in YYYY-MM-DD, times HH:MM 24h. Fill only known fields. If nothing, return empty arrays."
-    )
     try:
         r = gpt_chat(
-            messages=[{"role":"system","content":prompt},{"role":"user","content":text[:8000]}],
+            messages=[EXTRACT_BOOKING_MSG, {"role":"user","content":text[:8000]}],
             timeout=25,
+            response_format={"type": "json_object"},
         )
-        s = (r.choices[0].message.content or "").strip()
-        s = s[s.find("{"):s.rfind("}")+1] if "{" in s and "}" in s else "{}"
-        obj = json.loads(s) if s else {}
+        obj = json.loads(r.choices[0].message.content or "{}")
         if "flights" not in obj:
             f = obj.get("flight")
             obj["flights"] = [f] if isinstance(f, dict) else []
@@ -439,13 +660,8 @@ def ai_extract_passport_from_image(image_url: str) -> Optional[dict]:
     if not openai_client:
         return None
     try:
-        prompt = (
-            "You are reading a passport photo. Return STRICT JSON with keys: "
-            "{ full_name, passport_number, nationality, birth_date, issue_date, expiry_date, mrz }. "
-            "Dates in YYYY-MM-DD when possible; unknown fields as null. No extra text."
-        )
         r = gpt_chat(messages=[
-            {"role":"system","content":prompt},
+            EXTRACT_PASSPORT_MSG,
             {"role":"user","content":[
                 {"type":"text", "text":"Extract the fields from this passport image."},
                 {"type":"image_url","image_url":{"url": image_url}}
@@ -467,19 +683,14 @@ def ai_extract_booking_from_image(image_url: str, hint: str = "") -> Dict[str, l
         return {"flights": [], "hotels": []}
     try:
         messages = [
-            {"role":"system","content":
-             "You read images of flight tickets and hotel confirmations and return STRICT JSON as: "
-             "{ flights:[{origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr,passengers}],"
-             "  hotels:[{hotel_name,city,checkin_date,checkout_date,address}] } (YYYY-MM-DD, HH:MM)."},
+            EXTRACT_BOOKING_IMAGE_MSG,
             {"role":"user","content":[
                 {"type":"text","text": (hint or "")},
                 {"type":"image_url","image_url":{"url": image_url}}
             ]}
         ]
-        r = gpt_chat(messages=messages, timeout=30)
-        s = (r.choices[0].message.content or "").strip()
-        s = s[s.find("{"):s.rfind("}")+1] if "{" in s and "}" in s else "{}"
-        obj = json.loads(s) if s else {}
+        r = gpt_chat(messages=messages, timeout=30, response_format={"type": "json_object"})
+        obj = json.loads(r.choices[0].message.content or "{}")
         return {
             "flights": obj.get("flights") or ([obj.get("flight")] if isinstance(obj.get("flight"), dict) else []) or [],
             "hotels":  obj.get("hotels")  or ([obj.get("hotel")] if isinstance(obj.get("hotel"), dict)  else []) or [],
@@ -497,67 +708,172 @@ def get_google_flow() -> Optional[Flow]:
     flow.redirect_uri = red
     return flow
 
+# Credentials ו-service של Calendar נשמרים בזיכרון; build() מפענח discovery document ויקר.
+# TTLCache אינו thread-safe – כל גישה ל-cache של ה-credentials (וכל refresh) תחת _google_lock.
+# ה-service מחזיק httplib2.Http שאינו thread-safe, ולכן נשמר ב-cache נפרד לכל thread.
+_google_creds_cache: TTLCache = TTLCache(maxsize=1024, ttl=3000)
+_google_lock = threading.RLock()
+_calendar_local = threading.local()
+
 def save_google_token(waid: str, creds: Credentials):
-    db = get_db()
     js = creds.to_json(); now = datetime.utcnow().isoformat()
-    db.execute(
+    db_write(lambda db: db.execute(
         "INSERT INTO google_tokens (waid, token_json, created_at, updated_at) VALUES (?,?,?,?) "
         "ON CONFLICT(waid) DO UPDATE SET token_json=excluded.token_json, updated_at=excluded.updated_at",
         (waid, js, now, now)
-    ); db.commit()
+    ))
+    with _google_lock:
+        _google_creds_cache[waid] = creds
 
 def load_google_creds(waid: str) -> Optional[Credentials]:
-    row = get_db().execute("SELECT token_json FROM google_tokens WHERE waid=?", (waid,)).fetchone()
-    if not row: return None
-    creds = Credentials.from_authorized_user_info(json.loads(row["token_json"]), scopes=["https://www.googleapis.com/auth/calendar"])
+    with _google_lock:
+        creds = _google_creds_cache.get(waid)
+    if creds is None:
+        row = get_db().execute("SELECT token_json FROM google_tokens WHERE waid=?", (waid,)).fetchone()
+        if not row: return None
+        creds = Credentials.from_authorized_user_info(json.loads(row["token_json"]), scopes=["https://www.googleapis.com/auth/calendar"])
+        with _google_lock:
+            creds = _google_creds_cache.setdefault(waid, creds)
     if creds.expired and creds.refresh_token:
-        try:
-            creds.refresh(GoogleRequest()); save_google_token(waid, creds)
-        except Exception as e:
-            logger.exception("Google token refresh failed: %s", e); return None
+        with _google_lock:
+            if creds.expired:   # ייתכן ש-thread אחר כבר רענן בזמן שחיכינו
+                try:
+                    creds.refresh(GoogleRequest()); save_google_token(waid, creds)
+                except Exception as e:
+                    _google_creds_cache.pop(waid, None)
+                    logger.exception("Google token refresh failed: %s", e); return None
     return creds
 
-def add_calendar_event(waid: str, summary: str, description: str, start_iso: str, end_iso: Optional[str] = None, all_day: bool = False):
+def _thread_calendar_services() -> TTLCache:
+    services = getattr(_calendar_local, "services", None)
+    if services is None:
+        services = _calendar_local.services = TTLCache(maxsize=256, ttl=3000)
+    return services
+
+def get_calendar_service(waid: str):
     creds = load_google_creds(waid)
-    if not creds: return False
+    if not creds: return None
+    services = _thread_calendar_services()
+    cached = services.get(waid)
+    if cached and cached[0] is creds:
+        return cached[1]
     service = build("calendar", "v3", credentials=creds, cache_discovery=False)
-    if all_day:
-        event = {"summary":summary,"description":description,"start":{"date":start_iso},"end":{"date": end_iso or start_iso}}
-    else:
-        event = {"summary":summary,"description":description,"start":{"dateTime":start_iso},"end":{"dateTime": end_iso or start_iso}}
+    services[waid] = (creds, service)
+    return service
+
+def calendar_event(summary: str, description: str, start_iso: str, end_iso: Optional[str] = None, all_day: bool = False) -> dict:
+    key = "date" if all_day else "dateTime"
+    return {"summary":summary,"description":description,"start":{key:start_iso},"end":{key: end_iso or start_iso}}
+
+def add_calendar_events(waid: str, events: List[dict]) -> int:
+    """Insert events in one batched HTTP round-trip; returns how many were created."""
+    if not events: return 0
+    service = get_calendar_service(waid)
+    if not service: return 0
+    created = []
+    def _on_done(request_id, response, exception):
+        if exception is not None:
+            logger.error("Google Calendar insert failed: %s", exception)
+        else:
+            created.append(request_id)
+    batch = service.new_batch_http_request(callback=_on_done)
+    for ev in events:
+        batch.add(service.events().insert(calendarId="primary", body=ev))
     try:
-        service.events().insert(calendarId="primary", body=event).execute(); return True
+        batch.execute()
     except Exception as e:
-        logger.exception("Google Calendar insert failed: %s", e); return False
+        logger.exception("Google Calendar batch insert failed: %s", e)
+    return len(created)
+
+HHMM_RGX = re.compile(r"\d{2}:\d{2}")
 
 def to_dt_iso(date_str: str, time_str: Optional[str]) -> Optional[str]:
     if not date_str: return None
-    if time_str and re.match(r"^\d{2}:\d{2}$", time_str): return f"{date_str}T{time_str}:00"
+    if time_str and HHMM_RGX.fullmatch(time_str): return f"{date_str}T{time_str}:00"
     return f"{date_str}T09:00:00"
 
 # ───────────────────────────── אינדוקס הזמנות ─────────────────────────────
-def index_booking_from_text(waid: str, text: str, source_file_id: Optional[str], raw_excerpt: str):
-    db = get_db()
+KNOWN_IATA = frozenset(CITY_MAP.values())
+HOTEL_HINT_RGX = re.compile(r"hotel|resort|hostel|check-?in|check-?out|מלון|צ'ק-אין|צ׳ק-אין", re.IGNORECASE)
+
+# PNR ושמות נוסעים רק כשהם מסומנים בתווית מפורשת; בלעדיהם הולכים ל-GPT (חיפוש לפי נוסע / ticket_names תלויים בהם)
+PNR_RGX = re.compile(
+    r"(?:PNR|booking\s*(?:reference|ref\.?|code)|confirmation\s*(?:number|code)|record\s*locator|reservation\s*code|קוד\s*הזמנה)"
+    r"\s*[:#]?\s*((?=[A-Z0-9]{0,5}[A-Z])[A-Z0-9]{6})\b",
+    re.IGNORECASE,
+)
+PAX_LINE_RGX = re.compile(
+    r"(?:passenger\s*names?|passengers?|travell?er\s*names?|travell?ers?|שם\s*(?:ה)?נוסע)\s*[:\-]\s*([^\n\r]{3,60})",
+    re.IGNORECASE,
+)
+PAX_NAME_RGX = re.compile(r"[A-Za-z][A-Za-z'\-]*(?:\s*/\s*|\s+)[A-Za-z][A-Za-z'\- ]*")
+PAX_TITLE_RGX = re.compile(r"\s+(?:MR|MRS|MS|MISS|MSTR|DR|CHD|INF)\.?$", re.IGNORECASE)
 
-    # נאיבי (fallback)
-    naive_flight = None
-    found_dates = parse_dates(text); found_times = parse_times(text); airports = detect_airports(text)
-    if airports["dest"]:
-        naive_flight = {
-            "origin": airports["origin"], "dest": airports["dest"],
-            "depart_date": (found_dates[0] if found_dates else None),
-            "depart_time": (found_times[0] if found_times else None),
-            "arrival_date": None, "arrival_time": None,
-            "airline": None, "flight_number": None, "pnr": None,
-        }
+def parse_pnr(text: str) -> Optional[str]:
+    m = PNR_RGX.search(text or "")
+    return m.group(1).upper() if m else None
 
-    ai = ai_extract_booking_from_text(text) if openai_client else {"flights": [], "hotels": []}
+def parse_passengers(text: str) -> List[str]:
+    out = []
+    for raw in PAX_LINE_RGX.findall(text or ""):
+        name = PAX_TITLE_RGX.sub("", raw.strip())
+        if PAX_NAME_RGX.fullmatch(name) and name.upper() not in out:
+            out.append(name.upper())
+    return out
+
+def _flight_complete(fl: dict) -> bool:
+    """Regex result good enough to skip GPT: all key fields incl. PNR and passengers, and airports we actually know."""
+    return (all(fl.get(k) for k in ("origin", "dest", "depart_date", "depart_time", "flight_number", "pnr", "passengers"))
+            and fl["origin"] in KNOWN_IATA and fl["dest"] in KNOWN_IATA)
+
+def _flight_slot(text: str, found_dates: List[str], found_times: List[str], flight_no: str) -> Tuple[Optional[str], Optional[str]]:
+    """Departure date/time only when unambiguous: the single date and time in the text, or the ones on the flight number's line."""
+    if len(found_dates) == 1 and len(found_times) == 1:
+        return found_dates[0], found_times[0]
+    for line in (text or "").splitlines():
+        if any(m.replace(" ", "") == flight_no for m in FLIGHT_NO_RGX.findall(line)):
+            dates, times = parse_dates(line), parse_times(line)
+            if len(dates) == 1 and times:
+                return dates[0], times[0]
+    return None, None
+
+def index_booking_from_text(waid: str, text: str, source_file_id: Optional[str], raw_excerpt: str,
+                            extracted: Optional[Dict[str, list]] = None):
+    naive_flight = None
+    if extracted is not None:
+        # כבר חולץ (למשל Vision) – אין צורך בקריאת GPT נוספת על אותו תוכן
+        ai = extracted
+    else:
+        # נאיבי (fallback)
+        found_dates = parse_dates(text); found_times = parse_times(text); airports = detect_airports(text)
+        flight_nos = list(dict.fromkeys(m.replace(" ", "") for m in FLIGHT_NO_RGX.findall(text or "")))
+        slot_date, slot_time = (_flight_slot(text, found_dates, found_times, flight_nos[0])
+                                if len(flight_nos) == 1 else (None, None))
+        if airports["dest"]:
+            naive_flight = {
+                "origin": airports["origin"], "dest": airports["dest"],
+                "depart_date": slot_date or (found_dates[0] if found_dates else None),
+                "depart_time": slot_time or (found_times[0] if found_times else None),
+                "arrival_date": None, "arrival_time": None,
+                "airline": None, "flight_number": (flight_nos[0] if flight_nos else None),
+                "pnr": parse_pnr(text), "passengers": parse_passengers(text),
+            }
+
+        # טיסה בודדת שהרג'קס חילץ במלואה ואין סימן למלון – מדלגים על GPT.
+        # התאריך/שעה הראשונים בטקסט הם לרוב תאריך ההנפקה, לכן רק כשהם חד-משמעיים (יחידים או בשורת הטיסה)
+        if (naive_flight and slot_date and slot_time and _flight_complete(naive_flight)
+                and not HOTEL_HINT_RGX.search(text or "")):
+            ai = {"flights": [naive_flight], "hotels": []}
+        else:
+            ai = ai_extract_booking_from_text(text) if openai_client else {"flights": [], "hotels": []}
     flights = ai.get("flights") or []
     hotels = ai.get("hotels") or []
 
     if not flights and naive_flight and naive_flight.get("dest") and naive_flight.get("depart_date"):
         flights = [naive_flight]
 
+    now = datetime.utcnow().isoformat()
+    flight_rows, hotel_rows, events = [], [], []
     for fl in flights:
         if not fl or not fl.get("dest") or not fl.get("depart_date"):
             continue
@@ -570,43 +886,51 @@ def index_booking_from_text(waid: str, text: str, source_file_id: Optional[str],
         else:
             pax_str = None
 
-        fid = uuid.uuid4().hex
-        db.execute(
-            """INSERT INTO flights
-               (id,waid,origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr,passenger_name,source_file_id,raw_excerpt,created_at)
-               VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (fid, waid, fl.get("origin"), fl.get("dest"),
+        flight_rows.append(
+            (uuid.uuid4().hex, waid, fl.get("origin"), fl.get("dest"),
              fl.get("depart_date"), fl.get("depart_time"),
              fl.get("arrival_date"), fl.get("arrival_time"),
              fl.get("airline"), fl.get("flight_number"),
-             fl.get("pnr"), pax_str, source_file_id, raw_excerpt, datetime.utcnow().isoformat())
+             fl.get("pnr"), pax_str, source_file_id, raw_excerpt, now)
         )
         start_iso = to_dt_iso(fl.get("depart_date"), fl.get("depart_time"))
         if start_iso:
             summary = f"✈️ {fl.get('origin') or ''}→{fl.get('dest') or ''} {fl.get('flight_number') or ''}".strip()
             desc = f"Airline: {fl.get('airline') or ''}\nPNR: {fl.get('pnr') or ''}"
-            add_calendar_event(waid, summary, desc, start_iso, None, all_day=False)
+            events.append(calendar_event(summary, desc, start_iso, None, all_day=False))
 
     for ho in hotels:
         if not ho or not ho.get("checkin_date"):
             continue
-        hid = uuid.uuid4().hex
-        db.execute(
-            """INSERT INTO hotels
-               (id,waid,hotel_name,city,checkin_date,checkout_date,address,source_file_id,raw_excerpt,created_at)
-               VALUES (?,?,?,?,?,?,?,?,?,?)""",
-            (hid, waid, ho.get("hotel_name"), ho.get("city"),
+        hotel_rows.append(
+            (uuid.uuid4().hex, waid, ho.get("hotel_name"), ho.get("city"),
              ho.get("checkin_date"), ho.get("checkout_date"),
-             ho.get("address"), source_file_id, raw_excerpt, datetime.utcnow().isoformat())
+             ho.get("address"), source_file_id, raw_excerpt, now)
         )
-        add_calendar_event(
-            waid,
+        events.append(calendar_event(
             f"🏨 Check-in: {ho.get('hotel_name') or ''}",
             f"City: {ho.get('city') or ''}\nAddress: {ho.get('address') or ''}",
             ho.get("checkin_date"), ho.get("checkout_date") or ho.get("checkin_date"),
             all_day=True
-        )
-    db.commit()
+        ))
+
+    def _insert(db):
+        if flight_rows:
+            db.executemany(
+                """INSERT INTO flights
+                   (id,waid,origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr,passenger_name,source_file_id,raw_excerpt,created_at)
+                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                flight_rows
+            )
+        if hotel_rows:
+            db.executemany(
+                """INSERT INTO hotels
+                   (id,waid,hotel_name,city,checkin_date,checkout_date,address,source_file_id,raw_excerpt,created_at)
+                   VALUES (?,?,?,?,?,?,?,?,?,?)""",
+                hotel_rows
+            )
+    db_write(_insert)
+    add_calendar_events(waid, events)
 
 # ───────────────────────────── קבצים ─────────────────────────────
 def guess_extension(content_type: str, fallback_from_url: str = "") -> str:
@@ -618,17 +942,73 @@ def guess_extension(content_type: str, fallback_from_url: str = "") -> str:
     if dot and suffix and len(suffix) <= 5: return "." + suffix
     return ".bin"
 
-def save_file_record(waid: str, fname: str, content_type: str, data: bytes, title: str = "", tags: str = "") -> str:
-    fid = uuid.uuid4().hex
+PDF_PAGE_CHAR_BUDGET = int(os.getenv("PDF_PAGE_CHAR_BUDGET", "2000"))
+
+# עצירה מוקדמת רק על שורת טיסה אמיתית: מספר טיסה שאינו חלק מתאריך/שעה ואינו מילה באנגלית ("BOOKED ON 12/01/2025"),
+# באותה שורה עם תאריך או זוג שדות מוכרים. FLIGHT_NO_RGX רופף מדי לזה בטקסט באותיות גדולות.
+PDF_FLIGHT_NO_RGX = re.compile(r"\b([A-Z]{2}|[A-Z]\d|\d[A-Z])\s?\d{1,4}\b(?![./:-]\d)")
+PDF_FLIGHT_NO_STOPWORDS = frozenset({
+    "AM", "AN", "AS", "AT", "BE", "BY", "DO", "GO", "IF", "IN", "IS", "IT", "ME", "MY",
+    "NO", "OF", "ON", "OR", "PM", "SO", "TO", "UP", "US", "WE",
+})
+
+def _pdf_has_flight_line(text: str) -> bool:
+    for line in text.splitlines():
+        for m in PDF_FLIGHT_NO_RGX.finditer(line):
+            if m.group(1) in PDF_FLIGHT_NO_STOPWORDS:
+                continue
+            rest = line[:m.start()] + " " + line[m.end():]
+            if parse_dates(rest) or len({c for c in IATA_RGX.findall(rest) if c in KNOWN_IATA}) >= 2:
+                return True
+    return False
+
+def extract_pdf_text(path: str, max_pages: int) -> str:
+    """Read PDF pages lazily; stop once a page has a flight number on the same line as a date or an IATA pair."""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    pages: List[str] = []
+    for i, page in enumerate(reader.pages):
+        if i >= max_pages:
+            break
+        t = page.extract_text() or ""
+        if i > 0:
+            t = t[:PDF_PAGE_CHAR_BUDGET]
+        pages.append(t)
+        if _pdf_has_flight_line(t):
+            break
+    return "\n".join(pages)
+
+DOWNLOAD_CHUNK = 64 * 1024
+COPY_CHUNK = 1024 * 1024
+
+def storage_name(fid: str, fname: str, content_type: str) -> str:
     name = secure_filename(fname) or f"file-{fid}"
     if "." not in name and content_type:
         name += guess_extension(content_type)
+    return name
+
+def write_storage_file(name: str, data) -> str:
+    """Write bytes, a file-like stream or an iterable of byte chunks to STORAGE_DIR; returns the path."""
     path = os.path.join(STORAGE_DIR, name)
     with open(path, "wb") as fp:
-        fp.write(data)
+        if isinstance(data, (bytes, bytearray)):
+            fp.write(data)
+        elif hasattr(data, "read"):
+            shutil.copyfileobj(data, fp, length=COPY_CHUNK)
+        else:
+            for chunk in data:
+                fp.write(chunk)
+    return path
 
-    db = get_db()
-    db.execute(
+def save_file_record(waid: str, fname: str, content_type: str, data, title: str = "", tags: str = "") -> str:
+    fid = uuid.uuid4().hex
+    name = storage_name(fid, fname, content_type)
+    path = write_storage_file(name, data)
+    return record_file(waid, fid, name, content_type, path, title=title, tags=tags)
+
+def record_file(waid: str, fid: str, name: str, content_type: str, path: str, title: str = "", tags: str = "") -> str:
+    """Register a file already on disk and index bookings/passports found in it."""
+    db_write(lambda db: db.execute(
         "INSERT INTO files (id,waid,filename,content_type,path,title,tags,uploaded_at) VALUES (?,?,?,?,?,?,?,?)",
         (
             fid,
@@ -640,23 +1020,20 @@ def save_file_record(waid: str, fname: str, content_type: str, data: bytes, titl
             tags,
             datetime.utcnow().isoformat(),
         ),
-    )
-    db.commit()
+    ))
 
     try:
         excerpt = f"{title or ''}\n{tags or ''}"
 
         if (content_type or "").lower().startswith("text/"):
-            text = data.decode("utf-8", errors="ignore")
+            with open(path, "rb") as fp:
+                text = fp.read().decode("utf-8", errors="ignore")
             excerpt += "\n" + text[:4000]
             index_booking_from_text(waid, text, fid, excerpt[:2000])
 
         elif (content_type or "").lower() in ("application/pdf",) or name.lower().endswith(".pdf"):
-            from pypdf import PdfReader
             max_pages = int(os.getenv("MAX_PDF_PAGES", "8"))
-            reader = PdfReader(path)
-            pages = [(p.extract_text() or "") for p in reader.pages[:max_pages]]
-            text = "\n".join(pages)
+            text = extract_pdf_text(path, max_pages)
             excerpt += "\n" + text[:4000]
             index_booking_from_text(waid, text, fid, excerpt[:2000])
 
@@ -666,7 +1043,7 @@ def save_file_record(waid: str, fname: str, content_type: str, data: bytes, titl
             # חילוץ טיסות/מלונות
             ai = ai_extract_booking_from_image(img_url, hint=f"File name: {name}")
             if ai:
-                index_booking_from_text(waid, json.dumps(ai, ensure_ascii=False), fid, f"vision:{name}")
+                index_booking_from_text(waid, json.dumps(ai, ensure_ascii=False), fid, f"vision:{name}", extracted=ai)
 
             # חילוץ דרכון
             p = ai_extract_passport_from_image(img_url)
@@ -677,7 +1054,8 @@ def save_file_record(waid: str, fname: str, content_type: str, data: bytes, titl
                     summary += f" – {p['full_name']}"
                 if p.get("expiry_date"):
                     summary += f" | תוקף עד {p['expiry_date']}"
-                send_whatsapp(waid, summary + "\nאפשר לבקש: 'שלח לי את צילום הדרכון האחרון'.")
+                # לא מעכבים את ה-webhook על POST נוסף ל-Twilio
+                EXECUTOR.submit(send_whatsapp, waid, summary + "\nאפשר לבקש: 'שלח לי את צילום הדרכון האחרון'.")
 
     except Exception as e:
         logger.exception("Index from file failed: %s", e)
@@ -685,26 +1063,42 @@ def save_file_record(waid: str, fname: str, content_type: str, data: bytes, titl
     return fid
 
 
+def _download_media(media_url: str, name: str) -> str:
+    """Stream a Twilio media URL straight to disk (no full copy in RAM); returns the path."""
+    with HTTP.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=30, stream=True) as r:
+        r.raise_for_status()
+        try:
+            return write_storage_file(name, r.iter_content(DOWNLOAD_CHUNK))
+        except Exception:
+            path = os.path.join(STORAGE_DIR, name)
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
 def handle_incoming_media(waid: str, num_media: int, body_text: str) -> List[str]:
     saved = []
-    if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN):
-        logger.warning("Media received but TWILIO creds missing.")
-        return saved
+    form = request.form
+    media = []
     for i in range(num_media):
-        media_url = request.form.get(f"MediaUrl{i}")
-        ctype = request.form.get(f"MediaContentType{i}") or "application/octet-stream"
+        media_url = form.get(f"MediaUrl{i}")
+        ctype = form.get(f"MediaContentType{i}") or "application/octet-stream"
         if not media_url:
             continue
+        url_name = os.path.basename(urlparse(media_url).path) or f"media-{uuid.uuid4().hex}"
+        ext = os.path.splitext(url_name)[1]
+        if not ext:
+            ext = guess_extension(ctype, media_url)
+            url_name += ext
+        fid = uuid.uuid4().hex
+        media.append((fid, storage_name(fid, url_name, ctype), ctype, media_url))
+
+    # הורדות במקביל; השמירה ל-DB והאינדוקס נשארים ב-thread שמחזיק את הקשר הבקשה (g/request)
+    futures = [EXECUTOR.submit(_download_media, url, name) for _, name, _, url in media]
+    for (fid, name, ctype, _), fut in zip(media, futures):
         try:
-            r = requests.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=30)
-            r.raise_for_status()
-            url_name = os.path.basename(urlparse(media_url).path) or f"media-{uuid.uuid4().hex}"
-            ext = os.path.splitext(url_name)[1]
-            if not ext:
-                ext = guess_extension(ctype, media_url)
-                url_name += ext
-            fid = save_file_record(
-                waid, url_name, ctype, r.content,
+            path = fut.result()
+            record_file(
+                waid, fid, name, ctype, path,
                 title=(body_text or "WhatsApp media")[:80], tags="whatsapp,media"
             )
             saved.append(fid)
@@ -776,34 +1170,36 @@ CATEGORY_MAP = {
     "לינה": ["מלון","לינה","hotel","hostel","resort","bungalow"],
     "תחבורה": ["מונית","תחבורה","taxi","bus","ferry","מעבורת","סירה","boat"],
 }
+CATEGORY_BY_KEYWORD = {k.lower(): cat for cat, kws in reversed(list(CATEGORY_MAP.items())) for k in kws}
+CATEGORY_RGX = re.compile("|".join(re.escape(k) for k in sorted(CATEGORY_BY_KEYWORD, key=len, reverse=True)), re.IGNORECASE)
+
 def infer_category(text: str) -> Optional[str]:
-    t = (text or "").lower()
-    for cat, kws in CATEGORY_MAP.items():
-        if any(k in t for k in kws): return cat
+    m = CATEGORY_RGX.search(text or "")
+    if m: return CATEGORY_BY_KEYWORD[m.group(0).lower()]
     return "כללי" if text else None
 
 def extract_city_tag(text: str) -> Optional[str]:
-    t = (text or "").lower()
-    for name in CITY_MAP.keys():
-        if name in t: return name
-    return None
+    m = CITY_RGX.search(text or "")
+    return m.group(0).lower() if m else None
+
+URL_RGX = re.compile(r"(https?://\S+)", re.IGNORECASE)
+MAPS_Q_RGX = re.compile(r"[?&]q=([^&]+)")
 
 def store_recommendation_if_relevant(waid: str, text: str, lat: Optional[str], lon: Optional[str]) -> None:
     if not text and not (lat and lon): return
-    url = None; m = re.search(r"(https?://\S+)", text or "", re.I)
+    url = None; m = URL_RGX.search(text) if text and "http" in text.lower() else None
     if m: url = m.group(1)
     city_tag = extract_city_tag(text or "") or None
     category = infer_category(text or "")
-    place_name = None; mq = re.search(r"[?&]q=([^&]+)", url or "")
+    place_name = None; mq = MAPS_Q_RGX.search(url) if url else None
     if mq: place_name = mq.group(1).replace("+"," ").strip()[:120]
     elif text: place_name = text.strip()[:120]
     try:
-        db = get_db()
-        db.execute(
+        db_write(lambda db: db.execute(
             "INSERT INTO recs (id,waid,text,place_name,city_tag,category,lat,lon,url,created_at) VALUES (?,?,?,?,?,?,?,?,?,?)",
             (uuid.uuid4().hex, waid, text or "", place_name, city_tag, category,
              float(lat) if lat else None, float(lon) if lon else None, url, datetime.utcnow().isoformat())
-        ); db.commit()
+        ))
     except Exception as e:
         logger.exception("Failed to store recommendation: %s", e)
 
@@ -815,10 +1211,9 @@ def _fw_fmt_time_both(iso_ts: str) -> str:
     except Exception:
         return iso_ts
     s_utc = t_utc.strftime("%Y-%m-%d %H:%M UTC")
-    if ZoneInfo:
+    if _TZ:
         try:
-            t_loc = t_utc.astimezone(ZoneInfo(TZ))
-            s_loc = t_loc.strftime(f"%Y-%m-%d %H:%M {TZ}")
+            s_loc = t_utc.astimezone(_TZ).strftime(_TZ_STRFMT)
             return f"{s_utc} | {s_loc}"
         except Exception: pass
     return s_utc
@@ -837,8 +1232,14 @@ def _fw_snapshot_from_aviationstack(rec: dict):
     airline = safe("airline","name")
     return {"status": status, "airline": airline, "flight": flight, "departure": dep, "arrival": arr}
 
-def _fw_snapshot_hash(snap: dict) -> str:
-    return hashlib.sha256(json.dumps(snap, sort_keys=True).encode("utf-8")).hexdigest()
+def _fw_snapshot_bytes(snap: dict) -> bytes:
+    # סריאליזציה קנונית אחת (מפתחות ממוינים) – משמשת גם ל-hash וגם לעמודת last_snapshot
+    return orjson.dumps(snap, option=orjson.OPT_SORT_KEYS)
+
+def _fw_snapshot_hash(blob: bytes) -> int:
+    # זיהוי שינוי בלבד, לא קריפטו: xxh3 64-bit, נשמר כ-INTEGER (signed, כמו ש-SQLite דורש)
+    h = xxhash.xxh3_64_intdigest(blob)
+    return h - (1 << 64) if h >= (1 << 63) else h
 
 def _fw_format_message(snap: dict) -> str:
     f = snap.get("flight", {}) or {}; dep = snap.get("departure", {}) or {}; arr = snap.get("arrival", {}) or {}
@@ -851,11 +1252,24 @@ def _fw_format_message(snap: dict) -> str:
         f"זמני הגעה: מתוכנן {_fw_fmt_time_both(arr.get('scheduled'))} | משוער {_fw_fmt_time_both(arr.get('estimated'))} | בפועל {_fw_fmt_time_both(arr.get('actual'))}",
     ]; return "\n".join(lines)
 
-def _fw_fetch_aviationstack(flight_iata: str, flight_date: Optional[str]):
+def _fw_recipients(primary_waid: str) -> List[str]:
+    return [primary_waid] + [normalize_waid(x.replace("whatsapp:","").lstrip("+")) for x in NOTIFY_CC_WAIDS if x]
+
+def _fw_send_batch(items: List[Tuple[str, str]]) -> None:
+    # ההתראה לכל נמען (ראשי + NOTIFY_CC_WAIDS)
+    send_whatsapp_many([(rcpt, body) for waid, body in items for rcpt in _fw_recipients(waid)])
+
+def _fw_fetch_aviationstack(flight_iata: str, flight_date: Optional[str], interactive: bool = False):
     if not AVIATIONSTACK_KEY: return {"error": "Missing AVIATIONSTACK_KEY"}
     params = {"access_key": AVIATIONSTACK_KEY, "flight_iata": flight_iata}
     if flight_date: params["flight_date"] = flight_date
-    r = requests.get(AVIATIONSTACK_URL, params=params, timeout=25)
+    try:
+        if interactive:
+            r = HTTP_INTERACTIVE.get(AVIATIONSTACK_URL, params=params, timeout=INTERACTIVE_TIMEOUT)
+        else:
+            r = HTTP.get(AVIATIONSTACK_URL, params=params, timeout=25)
+    except requests.RequestException as e:
+        return {"error": f"aviationstack request failed: {e}"}
     if r.status_code != 200:
         return {"error": f"aviationstack HTTP {r.status_code}", "body": r.text}
     try: data = r.json()
@@ -865,8 +1279,9 @@ def _fw_fetch_aviationstack(flight_iata: str, flight_date: Optional[str]):
 # ───────────────────────────── שאילתות טיסות ─────────────────────────────
 def upcoming_flights_for_waid(waid: str, days_ahead: int = DEFAULT_LOOKAHEAD_DAYS, limit: int = 3):
     db = get_db()
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    until = (datetime.utcnow() + timedelta(days=days_ahead)).strftime("%Y-%m-%d")
+    now = datetime.utcnow()
+    today = date_str(now)
+    until = date_str(now + timedelta(days=days_ahead))
     rows = db.execute("""
         SELECT origin,dest,depart_date,depart_time,airline,flight_number,pnr,arrival_date,arrival_time
         FROM flights
@@ -876,9 +1291,13 @@ def upcoming_flights_for_waid(waid: str, days_ahead: int = DEFAULT_LOOKAHEAD_DAY
     """, (waid, today, until, limit)).fetchall()
     return rows
 
+SCOPE_NEXT = frozenset({"latest", "next", "קרובה", "קרוב"})
+SCOPE_RETURN = frozenset({"return", "חזור", "חזרה"})
+SCOPE_ALL = frozenset({"all", "כל"})
+
 def pick_flights_for_details(waid: str, scope: str = "latest"):
     db = get_db()
-    today = datetime.utcnow().strftime("%Y-%m-%d")
+    today = date_str(datetime.utcnow())
     rows = db.execute("""
         SELECT origin,dest,depart_date,depart_time,arrival_date,arrival_time,airline,flight_number,pnr
         FROM flights
@@ -889,11 +1308,11 @@ def pick_flights_for_details(waid: str, scope: str = "latest"):
     if not rows:
         return []
     scope = (scope or "latest").lower()
-    if scope in ("latest","next","קרובה","קרוב"):
+    if scope in SCOPE_NEXT:
         return [rows[0]]
-    if scope in ("return","חזור","חזרה"):
+    if scope in SCOPE_RETURN:
         return rows[-1:] if len(rows) > 1 else [rows[0]]
-    if scope in ("all","כל"):
+    if scope in SCOPE_ALL:
         return rows
     return rows[:2]
 
@@ -914,18 +1333,15 @@ def format_flight_details(rows):
     return "\n".join(lines).strip()
 
 # ───────────────────────────── NL Router (GPT-5) ─────────────────────────────
-def nl_route(user_text: str) -> Optional[dict]:
-    if not openai_client or not (user_text or "").strip():
-        return {"type": "general_chat", "params": {"prompt": user_text or ""}}
-
-    sys = (
-        "You are a router for a WhatsApp travel assistant. "
-        "Return STRICT JSON only with fields 'type' and 'params'. "
-        "If unsure, choose 'general_chat' with {prompt: <original text>}.\n"
-        "Dates must be YYYY-MM-DD; IATA flight codes like LY81; Hebrew/English both allowed."
-    )
+# הנחיות ה-router קבועות – נבנות פעם אחת בטעינה ולא בכל הודעה
+NL_ROUTE_SYSTEM_PROMPT = (
+    "You are a router for a WhatsApp travel assistant. "
+    "Return STRICT JSON only with fields 'type' and 'params'. "
+    "If unsure, choose 'general_chat' with {prompt: <original text>}.\n"
+    "Dates must be YYYY-MM-DD; IATA flight codes like LY81; Hebrew/English both allowed."
+)
 
-    examples = """
+NL_ROUTE_EXAMPLES = """
 שאלות → תשובות (JSON בלבד):
 - "מה הטיסות שלי לשבוע הקרוב?" ->
   {"type":"list_user_flights","params":{"range_days":7}}
@@ -975,12 +1391,91 @@ def nl_route(user_text: str) -> Optional[dict]:
 אם לא ברור:
 - "מה קורה?" -> {"type":"general_chat","params":{"prompt":"מה קורה?"}}
 """
+NL_ROUTE_SYSTEM_MSG = {"role": "system", "content": NL_ROUTE_SYSTEM_PROMPT}
+NL_ROUTE_USER_SUFFIX = f"\n\n{NL_ROUTE_EXAMPLES}\nReturn JSON only."
+
+# ניתובים חוזרים ("מה הטיסות שלי") נשמרים לשעה; טקסט ארוך כמעט לא חוזר ולכן לא נשמר
+NL_ROUTE_CACHE_MAX_LEN = 160
+_nl_route_cache: TTLCache = TTLCache(maxsize=2048, ttl=3600)
+_nl_route_cache_lock = threading.Lock()   # cachetools אינו thread-safe (gthread)
+WS_RGX = re.compile(r"\s+")
+
+def _route_copy(route: dict, user_text: str) -> dict:
+    params = route.get("params")
+    params = dict(params) if isinstance(params, dict) else {}
+    if route.get("type") == "general_chat":
+        params["prompt"] = user_text
+    return {"type": route["type"], "params": params}
+
+# פקודות קצרות וחד-משמעיות מנותבות מקומית בלי קריאה ל-OpenAI.
+# התבניות מעוגנות לכל ההודעה (fullmatch), כך שכל ניסוח עם פרטים נוספים (טווח תאריכים, שם נוסע) ממשיך ל-GPT.
+# כמו FLIGHT_NO_RGX: לפחות אות אחת בקידומת, כדי ש"עקוב אחרי 2025" לא ייקלט כקוד טיסה
+_FLIGHT_CODE = r"((?:[a-z]{2}|[a-z]\d|\d[a-z])) ?(\d{1,4})"
+
+def _flight_code(m: "re.Match") -> str:
+    return "".join(part for part in m.groups() if part).upper()
+
+LOCAL_RULES = [
+    (re.compile(r"(?:מה|הראה לי|תראה לי|תן לי) (?:את )?הטיסות של(?:י|נו)|my flights"),
+     lambda m: {"type": "list_user_flights", "params": {}}),
+    (re.compile(rf"(?:מה )?(?:ה)?סטטוס(?: של)?(?: טיסה)? {_FLIGHT_CODE}|(?:flight )?status(?: of)? {_FLIGHT_CODE}"),
+     lambda m: {"type": "flight_status", "params": {"iata": _flight_code(m)}}),
+    (re.compile(rf"עקוב (?:אחרי |אחר )?(?:ה)?(?:טיסה )?{_FLIGHT_CODE}|track(?: flight)? {_FLIGHT_CODE}"),
+     lambda m: {"type": "subscribe_flight", "params": {"iata": _flight_code(m)}}),
+    (re.compile(r"בטל (?:את )?(?:כל )?(?:ה)?מעקב(?:ים)?"),
+     lambda m: {"type": "cancel_flight", "params": {}}),
+    (re.compile(r"(?:ה)?רשימת (?:ה)?קבצים|(?:ה)?קבצים שלי|list files"),
+     lambda m: {"type": "list_files", "params": {"limit": 20}}),
+    (re.compile(r"כמה קבצים(?: שמורים)?(?: יש(?: לך| לי)?)?(?: שמורים)?"),
+     lambda m: {"type": "files_count", "params": {}}),
+    (re.compile(r"(?:שלח|תן)(?: לי)? (?:את )?(?:ה)?(?:קובץ|כרטיס) (?:ה)?אחרון"),
+     lambda m: {"type": "send_last_ticket", "params": {}}),
+    (re.compile(r"(?:שלח|תן)(?: לי)? (?:את )?(?:ה)?קובץ (?:מספר |מס' )?(\d{1,3})"),
+     lambda m: {"type": "send_file", "params": {"index": int(m.group(1))}}),
+    (re.compile(r"(?:תן |שלח )?(?:לי )?(?:את )?(?:ה)?קישור ליומן|calendar link"),
+     lambda m: {"type": "calendar_link", "params": {}}),
+]
+TRAILING_PUNCT_RGX = re.compile(r"[\s?!.,]+$")
+# כל מילות הפתיחה האפשריות של LOCAL_RULES; הודעה שלא מתחילה באחת מהן (רוב הצ'אט החופשי) לא עוברת על הטבלה
+LOCAL_RULE_PREFIXES = (
+    "מה ", "הראה", "תראה", "תן", "שלח", "לי ", "את ", "my ", "סטטוס", "הסטטוס", "status", "flight",
+    "עקוב", "track", "בטל", "רשימת", "הרשימת", "קבצים", "הקבצים", "list", "כמה", "קישור", "הקישור", "calendar",
+)
+LOCAL_ROUTE_MAX_LEN = 64
+
+def _local_route(norm: str) -> Optional[dict]:
+    if len(norm) > LOCAL_ROUTE_MAX_LEN or not norm.startswith(LOCAL_RULE_PREFIXES):
+        return None
+    norm = TRAILING_PUNCT_RGX.sub("", norm)
+    for rgx, make_route in LOCAL_RULES:
+        m = rgx.fullmatch(norm)
+        if m:
+            return make_route(m)
+    return None
+
+def nl_route(user_text: str) -> Optional[dict]:
+    if not (user_text or "").strip():
+        return {"type": "general_chat", "params": {"prompt": user_text or ""}}
+
+    norm = WS_RGX.sub(" ", user_text.strip().lower())
+    local = _local_route(norm)
+    if local:
+        return local
+    if not openai_client:
+        return {"type": "general_chat", "params": {"prompt": user_text}}
+
+    cacheable = len(norm) <= NL_ROUTE_CACHE_MAX_LEN
+    if cacheable:
+        with _nl_route_cache_lock:
+            hit = _nl_route_cache.get(norm)
+        if hit:
+            return _route_copy(hit, user_text)
 
     try:
         r = gpt_chat(
             messages=[
-                {"role": "system", "content": sys},
-                {"role": "user", "content": f"Text:\n{user_text}\n\n{examples}\nReturn JSON only."}
+                NL_ROUTE_SYSTEM_MSG,
+                {"role": "user", "content": "Text:\n" + user_text + NL_ROUTE_USER_SUFFIX}
             ],
             timeout=20
         )
@@ -989,28 +1484,43 @@ def nl_route(user_text: str) -> Optional[dict]:
         if start != -1 and end != -1:
             obj = json.loads(s[start:end+1])
             if isinstance(obj, dict) and obj.get("type"):
-                return obj
+                if cacheable:
+                    with _nl_route_cache_lock:
+                        _nl_route_cache[norm] = obj
+                return _route_copy(obj, user_text)
     except Exception as e:
         logger.warning("nl_route error: %s", e)
 
     return {"type": "general_chat", "params": {"prompt": user_text or ""}}
 
 # ───────────────────────────── Routes ─────────────────────────────
-@app.route("/", methods=["GET", "HEAD"])
-@app.route("/health", methods=["GET"])
-def health():
-    return "Your service is live 🎉", 200
+# בדיקות החיים של Render (/, /health) נענות ישירות ב-WSGI – בלי routing, context ו-Response של Flask
+_HEALTH_BODY = "Your service is live 🎉".encode("utf-8")
+_HEALTH_HEADERS = [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", str(len(_HEALTH_BODY)))]
+_HEALTH_PATHS = frozenset({"/", "/health"})
+
+def _health_middleware(flask_wsgi_app):
+    def wsgi(environ, start_response):
+        if environ.get("PATH_INFO") in _HEALTH_PATHS and environ.get("REQUEST_METHOD") in ("GET", "HEAD"):
+            start_response("200 OK", list(_HEALTH_HEADERS))
+            return [b""] if environ["REQUEST_METHOD"] == "HEAD" else [_HEALTH_BODY]
+        return flask_wsgi_app(environ, start_response)
+    return wsgi
+
+app.wsgi_app = _health_middleware(app.wsgi_app)
 
 @app.route("/status", methods=["GET"])
 def status():
     db = get_db()
-    f = db.execute("SELECT COUNT(*) c FROM files").fetchone()["c"]
-    fl = db.execute("SELECT COUNT(*) c FROM flights").fetchone()["c"]
-    h = db.execute("SELECT COUNT(*) c FROM hotels").fetchone()["c"]
-    r = db.execute("SELECT COUNT(*) c FROM recs").fetchone()["c"]
-    gcount = db.execute("SELECT COUNT(*) c FROM google_tokens").fetchone()["c"]
-    fw = db.execute("SELECT COUNT(*) c FROM flight_watch").fetchone()["c"]
-    return jsonify(ok=True, files=f, flights=fl, hotels=h, recs=r, google_tokens=gcount, flight_watch=fw, now=str(tz_now()))
+    c = db.execute("""
+        SELECT (SELECT COUNT(*) FROM files) AS files,
+               (SELECT COUNT(*) FROM flights) AS flights,
+               (SELECT COUNT(*) FROM hotels) AS hotels,
+               (SELECT COUNT(*) FROM recs) AS recs,
+               (SELECT COUNT(*) FROM google_tokens) AS google_tokens,
+               (SELECT COUNT(*) FROM flight_watch) AS flight_watch
+    """).fetchone()
+    return jsonify(ok=True, **dict(c), now=str(tz_now()))
 
 # Upload/Files/ICS
 @app.route("/upload", methods=["POST"])
@@ -1022,7 +1532,7 @@ def upload():
     tags = request.form.get("tags") or ""
     if not f or not waid:
         return jsonify({"ok": False, "error": "missing file or waid"}), 400
-    fid = save_file_record(waid, f.filename or f"upload-{uuid.uuid4().hex}", f.mimetype or "application/octet-stream", f.read(), title=title, tags=tags)
+    fid = save_file_record(waid, f.filename or f"upload-{uuid.uuid4().hex}", f.mimetype or "application/octet-stream", f.stream, title=title, tags=tags)
     url = public_base_url() + f"files/{fid}"
     return jsonify(ok=True, file_id=fid, url=url)
 
@@ -1033,27 +1543,40 @@ def serve_file(file_id):
     if not row: abort(404)
     return send_file(row["path"], mimetype=row["content_type"], as_attachment=False, download_name=row["filename"])
 
+# ICS: השדות מעוצבים ב-SQL, תבנית אחת לכל אירוע, והגוף נשלח בזרימה תוך כדי מעבר על השורות
+ICS_HEADER = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//ThailandBotAI//Travel//EN"
+ICS_FLIGHT_TMPL = ("\r\nBEGIN:VEVENT\r\nUID:{id}@thailandbot\r\nDTSTART:{start}\r\nSUMMARY:{summary}"
+                   "\r\nDESCRIPTION:Airline: {airline}\\nPNR: {pnr}\r\nEND:VEVENT")
+ICS_HOTEL_TMPL = ("\r\nBEGIN:VEVENT\r\nUID:{id}@thailandbot\r\nDTSTART;VALUE=DATE:{start}\r\nDTEND;VALUE=DATE:{dtend}"
+                  "\r\nSUMMARY:Hotel: {name}\r\nDESCRIPTION:City: {city}\\nAddress: {address}\r\nEND:VEVENT")
+ICS_FLIGHTS_SQL = """
+    SELECT id,
+           REPLACE(depart_date,'-','') || 'T' || REPLACE(COALESCE(NULLIF(depart_time,''),'09:00'),':','') || '00Z' AS start,
+           RTRIM('Flight ' || IFNULL(origin,'') || '->' || IFNULL(dest,'') || ' ' || IFNULL(flight_number,'')) AS summary,
+           IFNULL(airline,'') AS airline, IFNULL(pnr,'') AS pnr
+    FROM flights WHERE waid=? ORDER BY depart_date
+"""
+ICS_HOTELS_SQL = """
+    SELECT id,
+           REPLACE(checkin_date,'-','') AS start,
+           REPLACE(COALESCE(NULLIF(checkout_date,''), checkin_date),'-','') AS dtend,
+           COALESCE(NULLIF(hotel_name,''),'Check-in') AS name,
+           IFNULL(city,'') AS city, IFNULL(address,'') AS address
+    FROM hotels WHERE waid=? ORDER BY checkin_date
+"""
+
+def _ics_stream(db, waid: str):
+    yield ICS_HEADER
+    for fl in db.execute(ICS_FLIGHTS_SQL, (waid,)):
+        yield ICS_FLIGHT_TMPL.format_map(fl)
+    for ho in db.execute(ICS_HOTELS_SQL, (waid,)):
+        yield ICS_HOTEL_TMPL.format_map(ho)
+    yield "\r\nEND:VCALENDAR"
+
 @app.route("/calendar/<path:waid>.ics", methods=["GET"])
 def calendar_ics(waid):
     waid = normalize_waid(waid)
-    db = get_db()
-    flights = db.execute("SELECT * FROM flights WHERE waid=? ORDER BY depart_date", (waid,)).fetchall()
-    hotels = db.execute("SELECT * FROM hotels WHERE waid=? ORDER BY checkin_date", (waid,)).fetchall()
-    lines = ["BEGIN:VCALENDAR","VERSION:2.0","PRODID:-//ThailandBotAI//Travel//EN"]
-    def dtstamp(d, t="09:00"): return d.replace("-","") + "T" + (t or "09:00").replace(":","") + "00Z"
-    for fl in flights:
-        start = dtstamp(fl["depart_date"], fl["depart_time"] or "09:00")
-        summ = f"Flight {fl['origin'] or ''}->{fl['dest'] or ''} {fl['flight_number'] or ''}".strip()
-        desc = f"Airline: {fl['airline'] or ''}\\nPNR: {fl['pnr'] or ''}"
-        lines += ["BEGIN:VEVENT", f"UID:{fl['id']}@thailandbot", f"DTSTART:{start}", f"SUMMARY:{summ}", f"DESCRIPTION:{desc}", "END:VEVENT"]
-    for ho in hotels:
-        lines += ["BEGIN:VEVENT", f"UID:{ho['id']}@thailandbot",
-                  f"DTSTART;VALUE=DATE:{(ho['checkin_date']).replace('-','')}",
-                  f"DTEND;VALUE=DATE:{(ho['checkout_date'] or ho['checkin_date']).replace('-','')}",
-                  f"SUMMARY:Hotel: {ho['hotel_name'] or 'Check-in'}",
-                  f"DESCRIPTION:City: {ho['city'] or ''}\\nAddress: {ho['address'] or ''}", "END:VEVENT"]
-    lines.append("END:VCALENDAR")
-    ics = "\r\n".join(lines); return Response(ics, mimetype="text/calendar")
+    return Response(stream_with_context(_ics_stream(get_db(), waid)), mimetype="text/calendar")
 
 # Google OAuth
 @app.route("/google/oauth/start", methods=["GET"])
@@ -1064,7 +1587,7 @@ def google_oauth_start():
     if not flow: return "Google OAuth not configured", 500
     auth_url, state = flow.authorization_url(access_type="offline", include_granted_scopes="true", prompt="consent")
     db = get_db()
-    db.execute("INSERT INTO oauth_states (state,waid,created_at) VALUES (?,?,?)", (state, waid, datetime.utcnow().isoformat())); db.commit()
+    db.execute("INSERT INTO oauth_states (state,waid,created_at) VALUES (?,?,?)", (state, waid, datetime.utcnow().isoformat()))
     return redirect(auth_url, code=302)
 
 @app.route("/google/oauth/callback", methods=["GET"])
@@ -1095,273 +1618,253 @@ def build_flight_links(origin: Optional[str], dest: str, depart: Optional[str])
     ky = f"https://www.kayak.com/flights/{o}-{d}/{kdate}"
     return gf, ky
 
-@app.route("/twilio/webhook", methods=["POST"])
-def twilio_webhook():
-    if not _validated_twilio_request():
-        abort(403)
-
-    from_ = request.form.get("From", "")
-    waid = normalize_waid(request.form.get("WaId", from_) or from_)
-    body = request.form.get("Body", "") or ""
-    num_media = int(request.form.get("NumMedia", "0") or 0)
-    latitude = request.form.get("Latitude")
-    longitude = request.form.get("Longitude")
-    address = request.form.get("Address")
-    label = request.form.get("Label")
-
-    resp = MessagingResponse()
-    saved_media: List[str] = []
-
-    # MEDIA שמירה+אינדוקס
-    if num_media > 0:
-        saved_media = handle_incoming_media(waid, num_media, body)
-        if saved_media:
-            try:
-                db = get_db()
-                rows = db.execute("""
-                    SELECT origin,dest,depart_date,depart_time,airline,flight_number,pnr,passenger_name
-                    FROM flights WHERE waid=? ORDER BY created_at DESC LIMIT 3
-                """, (waid,)).fetchall()
-                if rows:
-                    latest_pax = next((r["passenger_name"] for r in rows if r["passenger_name"]), None)
-                    latest_pnr = next((r["pnr"] for r in rows if r["pnr"]), None)
-                    lines = [f"📎 שמרתי {len(saved_media)} קבצים.", "✈️ מצאתי:"]
-                    for fl in rows[::-1]:
-                        lines.append(
-                            f"- {fl['depart_date']} {fl['depart_time'] or ''} {fl['origin'] or ''}→{fl['dest'] or ''} "
-                            f"{(fl['flight_number'] or '').strip()} | {fl['airline'] or ''}"
-                        )
-                    if latest_pnr: lines.append(f"• PNR: {latest_pnr}")
-                    if latest_pax: lines.append(f"• נוסעים: {latest_pax}")
-                    lines.append("אפשר לבקש: 'רשימת קבצים' / 'שלח את הקובץ מספר 2' / 'תן את הכרטיס של דולב' / 'מה הטיסות שלי' וכו׳")
-                    for ch in chunk_text("\n".join(lines)): resp.message(ch)
-                else:
-                    resp.message(f"📎 שמרתי {len(saved_media)} קבצים. ניסיתי לחלץ פרטים – אם לא הופיע סיכום, שלחו קובץ אחר או כתבו מה תרצו שאעשה.")
-            except Exception as e:
-                logger.exception("Post-media summary failed: %s", e)
-                resp.message(f"📎 שמרתי {len(saved_media)} קבצים. אפשר לבקש: 'מה הטיסות שלי' או 'רשימת קבצים'.")
-            return str(resp)
-
-    # שמירת לינקים/מיקום כהמלצה
-    if body or (latitude and longitude):
-        store_recommendation_if_relevant(waid, body, latitude, longitude)
-
-    # GPT Router
-    nl = nl_route(body)
-    t = (nl or {}).get("type") or "general_chat"
-    p = (nl or {}).get("params") or {}
-
-    # פעולות
-    if t == "list_user_flights":
-        rows = upcoming_flights_for_waid(waid, int(p.get("range_days", DEFAULT_LOOKAHEAD_DAYS)))
+# ───────────────────────────── מדיה נכנסת (ברקע) ─────────────────────────────
+def _media_summary(waid: str, saved_media: List[str]) -> str:
+    try:
+        rows = get_db().execute("""
+            SELECT origin,dest,depart_date,depart_time,airline,flight_number,pnr,passenger_name
+            FROM flights WHERE waid=? ORDER BY created_at DESC LIMIT 3
+        """, (waid,)).fetchall()
         if not rows:
-            resp.message("לא מצאתי טיסות קרובות.")
-            return str(resp)
-        lines = ["✈️ הטיסות הקרובות שלך:"] + [
-            f"- {r['depart_date']} {r['depart_time'] or ''} {r['origin'] or ''}→{r['dest'] or ''} "
-            f"{(r['flight_number'] or '').strip()}{(' | ' + r['airline']) if r['airline'] else ''}"
-            for r in rows
-        ]
-        for ch in chunk_text("\n".join(lines)):
-            resp.message(ch)
-        return str(resp)
+            return f"📎 שמרתי {len(saved_media)} קבצים. ניסיתי לחלץ פרטים – אם לא הופיע סיכום, שלחו קובץ אחר או כתבו מה תרצו שאעשה."
+        latest_pax = next((r["passenger_name"] for r in rows if r["passenger_name"]), None)
+        latest_pnr = next((r["pnr"] for r in rows if r["pnr"]), None)
+        lines = [f"📎 שמרתי {len(saved_media)} קבצים.", "✈️ מצאתי:"]
+        for fl in rows[::-1]:
+            lines.append(
+                f"- {fl['depart_date']} {fl['depart_time'] or ''} {fl['origin'] or ''}→{fl['dest'] or ''} "
+                f"{(fl['flight_number'] or '').strip()} | {fl['airline'] or ''}"
+            )
+        if latest_pnr: lines.append(f"• PNR: {latest_pnr}")
+        if latest_pax: lines.append(f"• נוסעים: {latest_pax}")
+        lines.append("אפשר לבקש: 'רשימת קבצים' / 'שלח את הקובץ מספר 2' / 'תן את הכרטיס של דולב' / 'מה הטיסות שלי' וכו׳")
+        return "\n".join(lines)
+    except Exception as e:
+        logger.exception("Post-media summary failed: %s", e)
+        return f"📎 שמרתי {len(saved_media)} קבצים. אפשר לבקש: 'מה הטיסות שלי' או 'רשימת קבצים'."
 
-    if t == "list_person_flights":
-        person = (p.get("person") or "").strip()
-        other = CONTACT_ALIASES.get(person)
-        if not other:
-            resp.message(f"לא מכיר את '{person}'. הוסף אותו ל-CONTACT_ALIASES ב-ENV.")
-            return str(resp)
-        other_waid = normalize_waid(other)
-        rows = upcoming_flights_for_waid(other_waid, int(p.get("range_days", DEFAULT_LOOKAHEAD_DAYS)))
-        if not rows:
-            resp.message(f"לא מצאתי טיסות קרובות עבור {person}.")
-            return str(resp)
-        lines = [f"✈️ הטיסות של {person}:"] + [
-            f"- {r['depart_date']} {r['depart_time'] or ''} {r['origin'] or ''}→{r['dest'] or ''} "
-            f"{(r['flight_number'] or '').strip()}{(' | ' + r['airline']) if r['airline'] else ''}"
-            for r in rows
-        ]
-        for ch in chunk_text("\n".join(lines)):
-            resp.message(ch)
+def _process_incoming_media(waid: str, num_media: int, body: str) -> None:
+    """Runs on BACKGROUND inside a copy of the webhook's request context; replies through the REST API."""
+    try:
+        saved = handle_incoming_media(waid, num_media, body)
+        msg = _media_summary(waid, saved) if saved else "⚠️ לא הצלחתי לשמור את הקבצים. נסו לשלוח שוב."
+    except Exception as e:
+        logger.exception("Background media processing failed: %s", e)
+        msg = "⚠️ לא הצלחתי לעבד את הקבצים. נסו לשלוח שוב."
+    for ch in chunk_text(msg):
+        send_whatsapp(waid, ch)
+
+# ───────────────────────────── פעולות (לפי type מה-router) ─────────────────────────────
+def _act_list_user_flights(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    rows = upcoming_flights_for_waid(waid, int(p.get("range_days", DEFAULT_LOOKAHEAD_DAYS)))
+    if not rows:
+        resp.message("לא מצאתי טיסות קרובות.")
         return str(resp)
+    lines = ["✈️ הטיסות הקרובות שלך:"] + [
+        f"- {r['depart_date']} {r['depart_time'] or ''} {r['origin'] or ''}→{r['dest'] or ''} "
+        f"{(r['flight_number'] or '').strip()}{(' | ' + r['airline']) if r['airline'] else ''}"
+        for r in rows
+    ]
+    for ch in chunk_text("\n".join(lines)):
+        resp.message(ch)
+    return str(resp)
 
-    if t == "subscribe_flight":
-        iata = (p.get("iata") or "").upper()
-        date = p.get("date")
-        if not iata:
-            resp.message("לא הצלחתי להבין את קוד הטיסה (דוגמה: LY81).")
-            return str(resp)
-        db = get_db()
-        db.execute(
-            "INSERT INTO flight_watch (waid, flight_iata, flight_date, provider, last_snapshot, last_hash) VALUES (?,?,?,?,?,?)",
-            (waid, iata, date, "aviationstack", None, None)
-        ); db.commit()
-        resp.message(f"מעולה! עוקב אחרי {iata}" + (f" ({date})" if date else ""))
+def _act_list_person_flights(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    person = (p.get("person") or "").strip()
+    other = CONTACT_ALIASES.get(person)
+    if not other:
+        resp.message(f"לא מכיר את '{person}'. הוסף אותו ל-CONTACT_ALIASES ב-ENV.")
         return str(resp)
-
-    if t == "cancel_flight":
-        iata = (p.get("iata") or "").upper()
-        db = get_db()
-        if iata:
-            db.execute("DELETE FROM flight_watch WHERE waid=? AND flight_iata=?", (waid, iata))
-        else:
-            db.execute("DELETE FROM flight_watch WHERE waid=?", (waid,))
-        n = db.total_changes; db.commit()
-        resp.message("בוטל מעקב" + (f" אחרי {iata}" if iata else " לכל הטיסות") + f" ({n} רשומות).")
+    other_waid = normalize_waid(other)
+    rows = upcoming_flights_for_waid(other_waid, int(p.get("range_days", DEFAULT_LOOKAHEAD_DAYS)))
+    if not rows:
+        resp.message(f"לא מצאתי טיסות קרובות עבור {person}.")
         return str(resp)
+    lines = [f"✈️ הטיסות של {person}:"] + [
+        f"- {r['depart_date']} {r['depart_time'] or ''} {r['origin'] or ''}→{r['dest'] or ''} "
+        f"{(r['flight_number'] or '').strip()}{(' | ' + r['airline']) if r['airline'] else ''}"
+        for r in rows
+    ]
+    for ch in chunk_text("\n".join(lines)):
+        resp.message(ch)
+    return str(resp)
 
-    if t == "flight_status":
-        iata = (p.get("iata") or "").upper()
-        if not iata:
-            resp.message("צריך מזהה טיסה, למשל: סטטוס LY81")
-            return str(resp)
-        res = _fw_fetch_aviationstack(iata, None)
-        if res.get("error") or not (res.get("data") or []):
-            resp.message("לא מצאתי סטטוס לטיסה הזו כרגע.")
-            return str(resp)
-        snap = _fw_snapshot_from_aviationstack(res["data"][0])
-        for ch in chunk_text(_fw_format_message(snap)):
-            resp.message(ch)
+def _act_subscribe_flight(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    iata = (p.get("iata") or "").upper()
+    date = p.get("date")
+    if not iata:
+        resp.message("לא הצלחתי להבין את קוד הטיסה (דוגמה: LY81).")
         return str(resp)
+    db = get_db()
+    db.execute(
+        "INSERT INTO flight_watch (waid, flight_iata, flight_date, provider, last_snapshot, last_hash) VALUES (?,?,?,?,?,?)",
+        (waid, iata, date, "aviationstack", None, None)
+    )
+    resp.message(f"מעולה! עוקב אחרי {iata}" + (f" ({date})" if date else ""))
+    return str(resp)
 
-    if t == "send_last_ticket":
-        db = get_db()
-        row = db.execute("SELECT * FROM files WHERE waid=? ORDER BY uploaded_at DESC LIMIT 1", (waid,)).fetchone()
-        if not row:
-            resp.message("לא מצאתי קובץ. שלחו PDF/תמונה או העלו דרך /upload.")
-            return str(resp)
-        file_url = public_base_url() + f"files/{row['id']}"
-        m = resp.message(f"📄 {row['filename']}"); m.media(file_url)
-        return str(resp)
+def _act_cancel_flight(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    iata = (p.get("iata") or "").upper()
+    db = get_db()
+    if iata:
+        cur = db.execute("DELETE FROM flight_watch WHERE waid=? AND flight_iata=?", (waid, iata))
+    else:
+        cur = db.execute("DELETE FROM flight_watch WHERE waid=?", (waid,))
+    n = cur.rowcount
+    resp.message("בוטל מעקב" + (f" אחרי {iata}" if iata else " לכל הטיסות") + f" ({n} רשומות).")
+    return str(resp)
 
-    if t == "flight_details":
-        scope = (p.get("scope") or "latest")
-        rows = pick_flights_for_details(waid, scope)
-        msg = format_flight_details(rows)
-        if rows:
-            ics = public_base_url() + f"calendar/{waid}.ics"
-            first_num = (rows[0]['flight_number'] or "").strip()
-            first_date = rows[0]['depart_date']
-            extra = f"\n📅 ICS: {ics}"
-            if first_num and first_date:
-                extra += f"\n🔔 מעקב: כתבו 'עקוב אחרי טיסה {first_num} {first_date}'"
-            msg += extra
-        for ch in chunk_text(msg): resp.message(ch)
+def _act_flight_status(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    iata = (p.get("iata") or "").upper()
+    if not iata:
+        resp.message("צריך מזהה טיסה, למשל: סטטוס LY81")
         return str(resp)
-
-    if t == "search_flights":
-        origin = p.get("origin") or "TLV"
-        dest = p.get("dest")
-        depart = p.get("depart_date")
-        if not dest:
-            resp.message("חסר יעד (dest). אפשר לכתוב: 'מצא טיסה TLV→BKK 2025-10-01'.")
-            return str(resp)
-        links = build_flight_links(origin, dest, depart)
-        msg = f"✈️ {origin} → {dest}\nתאריך יציאה: {depart or 'בחר תאריך'}\nGoogle Flights: {links[0]}\nKayak: {links[1]}"
-        for ch in chunk_text(msg): resp.message(ch)
+    res = _fw_fetch_aviationstack(iata, None, interactive=True)
+    if res.get("error") or not (res.get("data") or []):
+        resp.message("לא מצאתי סטטוס לטיסה הזו כרגע.")
         return str(resp)
+    snap = _fw_snapshot_from_aviationstack(res["data"][0])
+    for ch in chunk_text(_fw_format_message(snap)):
+        resp.message(ch)
+    return str(resp)
 
-    if t == "recs_query":
-        city = p.get("city"); cat = p.get("category")
-        db = get_db()
-        q = "SELECT place_name,url,text,category,city_tag FROM recs WHERE waid=?"
-        params: List[str] = [waid]
-        if city: q += " AND LOWER(IFNULL(city_tag,'')) LIKE ?"; params.append(f"%{str(city).lower()}%")
-        if cat and cat != "כללי": q += " AND LOWER(IFNULL(category,'')) LIKE ?"; params.append(f"%{str(cat).lower()}%")
-        q += " ORDER BY created_at DESC LIMIT 12"
-        rows = db.execute(q, tuple(params)).fetchall()
-        if not rows:
-            resp.message("לא מצאתי המלצות תואמות. שלחו לינקים/מקומות ואשמור לפי עיר/קטגוריה.")
-            return str(resp)
-        lines = [f"⭐ המלצות{(' ל-' + city) if city else ''}{(' – ' + cat) if cat and cat!='כללי' else ''}:"]
-        for r in rows:
-            title = r["place_name"] or (r["text"][:60] if r["text"] else "מקום")
-            lines.append(f"• {title}" + (f" — {r['url']}" if r["url"] else ""))
-        for ch in chunk_text("\n".join(lines)): resp.message(ch)
+def _act_send_last_ticket(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    db = get_db()
+    row = db.execute("SELECT * FROM files WHERE waid=? ORDER BY uploaded_at DESC LIMIT 1", (waid,)).fetchone()
+    if not row:
+        resp.message("לא מצאתי קובץ. שלחו PDF/תמונה או העלו דרך /upload.")
         return str(resp)
+    file_url = public_base_url() + f"files/{row['id']}"
+    m = resp.message(f"📄 {row['filename']}"); m.media(file_url)
+    return str(resp)
 
-    if t == "files_count":
-        c = get_db().execute("SELECT COUNT(*) AS c FROM files WHERE waid=?", (waid,)).fetchone()["c"]
-        resp.message(f"יש לך {c} קבצים שמורים.")
-        return str(resp)
+def _act_flight_details(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    scope = (p.get("scope") or "latest")
+    rows = pick_flights_for_details(waid, scope)
+    msg = format_flight_details(rows)
+    if rows:
+        ics = public_base_url() + f"calendar/{waid}.ics"
+        first_num = (rows[0]['flight_number'] or "").strip()
+        first_date = rows[0]['depart_date']
+        extra = f"\n📅 ICS: {ics}"
+        if first_num and first_date:
+            extra += f"\n🔔 מעקב: כתבו 'עקוב אחרי טיסה {first_num} {first_date}'"
+        msg += extra
+    for ch in chunk_text(msg): resp.message(ch)
+    return str(resp)
 
-    if t == "ticket_names":
-        row = get_db().execute(
-            "SELECT passenger_name, pnr FROM flights WHERE waid=? AND passenger_name IS NOT NULL "
-            "ORDER BY created_at DESC LIMIT 1",
-            (waid,)
-        ).fetchone()
-        if not row:
-            resp.message("לא מצאתי שמות נוסעים מהכרטיסים האחרונים. שלחו את ה-PDF ואחלץ שוב.")
-            return str(resp)
-        msg = f"👤 נוסעים: {row['passenger_name']}"
-        if row["pnr"]: msg += f"\nPNR: {row['pnr']}"
-        for ch in chunk_text(msg): resp.message(ch)
+def _act_search_flights(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    origin = p.get("origin") or "TLV"
+    dest = p.get("dest")
+    depart = p.get("depart_date")
+    if not dest:
+        resp.message("חסר יעד (dest). אפשר לכתוב: 'מצא טיסה TLV→BKK 2025-10-01'.")
         return str(resp)
+    links = build_flight_links(origin, dest, depart)
+    msg = f"✈️ {origin} → {dest}\nתאריך יציאה: {depart or 'בחר תאריך'}\nGoogle Flights: {links[0]}\nKayak: {links[1]}"
+    for ch in chunk_text(msg): resp.message(ch)
+    return str(resp)
 
-    if t == "calendar_link":
-        ics = public_base_url() + f"calendar/{waid}.ics"
-        resp.message(f"📅 ה-ICS האישי שלך: {ics}")
+def _act_recs_query(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    city = p.get("city"); cat = p.get("category")
+    db = get_db()
+    q = "SELECT place_name,url,text,category,city_tag FROM recs WHERE waid=?"
+    params: List[str] = [waid]
+    if city: q += " AND LOWER(IFNULL(city_tag,'')) LIKE ?"; params.append(f"%{str(city).lower()}%")
+    if cat and cat != "כללי": q += " AND LOWER(IFNULL(category,'')) LIKE ?"; params.append(f"%{str(cat).lower()}%")
+    q += " ORDER BY created_at DESC LIMIT 12"
+    rows = db.execute(q, tuple(params)).fetchall()
+    if not rows:
+        resp.message("לא מצאתי המלצות תואמות. שלחו לינקים/מקומות ואשמור לפי עיר/קטגוריה.")
         return str(resp)
+    lines = [f"⭐ המלצות{(' ל-' + city) if city else ''}{(' – ' + cat) if cat and cat!='כללי' else ''}:"]
+    for r in rows:
+        title = r["place_name"] or (r["text"][:60] if r["text"] else "מקום")
+        lines.append(f"• {title}" + (f" — {r['url']}" if r["url"] else ""))
+    for ch in chunk_text("\n".join(lines)): resp.message(ch)
+    return str(resp)
 
-    if t == "list_files":
-        limit = min(int(p.get("limit", 20)), 50)
-        rows, total = list_files_for_waid(waid, limit=limit, offset=int(p.get("offset", 0) or 0))
-        if not rows:
-            resp.message("לא שמרתי עדיין קבצים עבורך.")
-            return str(resp)
-        lines = [f"📁 הקבצים האחרונים ({len(rows)}/{total}):"]
-        for i, r in enumerate(rows, 1):
-            url = public_base_url() + f"files/{r['id']}"
-            lines.append(f"{i}. {r['filename']} — {r['uploaded_at']}\n{url}")
-        for ch in chunk_text("\n".join(lines)): resp.message(ch)
+def _act_files_count(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    c = get_db().execute("SELECT COUNT(*) AS c FROM files WHERE waid=?", (waid,)).fetchone()["c"]
+    resp.message(f"יש לך {c} קבצים שמורים.")
+    return str(resp)
+
+def _act_ticket_names(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    row = get_db().execute(
+        "SELECT passenger_name, pnr FROM flights WHERE waid=? AND passenger_name IS NOT NULL "
+        "ORDER BY created_at DESC LIMIT 1",
+        (waid,)
+    ).fetchone()
+    if not row:
+        resp.message("לא מצאתי שמות נוסעים מהכרטיסים האחרונים. שלחו את ה-PDF ואחלץ שוב.")
         return str(resp)
+    msg = f"👤 נוסעים: {row['passenger_name']}"
+    if row["pnr"]: msg += f"\nPNR: {row['pnr']}"
+    for ch in chunk_text(msg): resp.message(ch)
+    return str(resp)
 
-    if t == "send_file":
-        passenger = (p.get("passenger") or "").strip() if isinstance(p.get("passenger"), str) else ""
-        if passenger:
-            row = get_file_by_passenger(waid, passenger)
-        else:
-            row = get_file_by_index_or_name(waid, index=p.get("index"), name=p.get("name"))
-        if not row:
-            resp.message("לא מצאתי קובץ תואם. נסה לפי שם הנוסע, מספר ברשימה או חלק מהשם.")
-            return str(resp)
-        file_url = public_base_url() + f"files/{row['id']}"
-        m = resp.message(f"📄 {row['filename']}"); m.media(file_url)
+def _act_calendar_link(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    ics = public_base_url() + f"calendar/{waid}.ics"
+    resp.message(f"📅 ה-ICS האישי שלך: {ics}")
+    return str(resp)
+
+def _act_list_files(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    limit = min(int(p.get("limit", 20)), 50)
+    rows, total = list_files_for_waid(waid, limit=limit, offset=int(p.get("offset", 0) or 0))
+    if not rows:
+        resp.message("לא שמרתי עדיין קבצים עבורך.")
         return str(resp)
+    lines = [f"📁 הקבצים האחרונים ({len(rows)}/{total}):"]
+    for i, r in enumerate(rows, 1):
+        url = public_base_url() + f"files/{r['id']}"
+        lines.append(f"{i}. {r['filename']} — {r['uploaded_at']}\n{url}")
+    for ch in chunk_text("\n".join(lines)): resp.message(ch)
+    return str(resp)
 
-    if t == "send_passport":
-        passenger = (p.get("passenger") or "").strip()
-        if not passenger:
-            resp.message("לא הצלחתי להבין את שם הנוסע בדרכון.")
-            return str(resp)
+def _act_send_file(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    passenger = (p.get("passenger") or "").strip() if isinstance(p.get("passenger"), str) else ""
+    if passenger:
+        row = get_file_by_passenger(waid, passenger)
+    else:
+        row = get_file_by_index_or_name(waid, index=p.get("index"), name=p.get("name"))
+    if not row:
+        resp.message("לא מצאתי קובץ תואם. נסה לפי שם הנוסע, מספר ברשימה או חלק מהשם.")
+        return str(resp)
+    file_url = public_base_url() + f"files/{row['id']}"
+    m = resp.message(f"📄 {row['filename']}"); m.media(file_url)
+    return str(resp)
 
-        db = get_db()
-        row = db.execute(
-            """SELECT f.*
-               FROM files f
-               JOIN passports ps ON ps.source_file_id = f.id
-               WHERE f.waid=? AND (
-                    LOWER(IFNULL(ps.full_name,'')) LIKE ?
-                 OR LOWER(f.filename) LIKE ?
-               )
-               ORDER BY f.uploaded_at DESC LIMIT 1""",
-            (waid, f"%{passenger.lower()}%", f"%{passenger.lower()}%")
-        ).fetchone()
+def _act_send_passport(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
+    passenger = (p.get("passenger") or "").strip()
+    if not passenger:
+        resp.message("לא הצלחתי להבין את שם הנוסע בדרכון.")
+        return str(resp)
 
-        if not row:
-            resp.message(f"לא מצאתי דרכון עבור {passenger}.")
-            return str(resp)
+    db = get_db()
+    row = db.execute(
+        """SELECT f.*
+           FROM files f
+           JOIN passports ps ON ps.source_file_id = f.id
+           WHERE f.waid=? AND (
+                LOWER(IFNULL(ps.full_name,'')) LIKE ?
+             OR LOWER(f.filename) LIKE ?
+           )
+           ORDER BY f.uploaded_at DESC LIMIT 1""",
+        (waid, f"%{passenger.lower()}%", f"%{passenger.lower()}%")
+    ).fetchone()
 
-        file_url = public_base_url() + f"files/{row['id']}"
-        m = resp.message(f"📇 דרכון של {passenger} – {row['filename']}")
-        m.media(file_url)
+    if not row:
+        resp.message(f"לא מצאתי דרכון עבור {passenger}.")
         return str(resp)
 
-    # ברירת מחדל – שיחה חופשית
+    file_url = public_base_url() + f"files/{row['id']}"
+    m = resp.message(f"📇 דרכון של {passenger} – {row['filename']}")
+    m.media(file_url)
+    return str(resp)
+
+def _act_general_chat(waid: str, p: dict, body: str, resp: MessagingResponse) -> str:
     user_text = (p.get("prompt") if isinstance(p.get("prompt"), str) else body) or body
-    history = chat_histories[waid]
+    history = load_chat_history(waid)
     try:
         r = gpt_chat(messages=build_messages(history, user_text), timeout=25)
         answer = (r.choices[0].message.content or "").strip() or "לא הצלחתי לענות כרגע."
@@ -1373,18 +1876,90 @@ def twilio_webhook():
 
     history.append({"role": "user", "content": user_text})
     history.append({"role": "assistant", "content": answer})
-    if len(history) > 20: del history[:-20]
+    save_chat_history(waid, history)
     for ch in chunk_text(answer): resp.message(ch)
     return str(resp)
 
+ROUTE_HANDLERS = {
+    "list_user_flights": _act_list_user_flights,
+    "list_person_flights": _act_list_person_flights,
+    "subscribe_flight": _act_subscribe_flight,
+    "cancel_flight": _act_cancel_flight,
+    "flight_status": _act_flight_status,
+    "send_last_ticket": _act_send_last_ticket,
+    "flight_details": _act_flight_details,
+    "search_flights": _act_search_flights,
+    "recs_query": _act_recs_query,
+    "files_count": _act_files_count,
+    "ticket_names": _act_ticket_names,
+    "calendar_link": _act_calendar_link,
+    "list_files": _act_list_files,
+    "send_file": _act_send_file,
+    "send_passport": _act_send_passport,
+}
+
+@app.route("/twilio/webhook", methods=["POST"])
+def twilio_webhook():
+    if not _validated_twilio_request():
+        abort(403)
+
+    form = request.form
+    from_ = form.get("From", "")
+    waid = normalize_waid(form.get("WaId", from_) or from_)
+    body = form.get("Body", "") or ""
+    num_media = int(form.get("NumMedia", "0") or 0)
+    latitude = form.get("Latitude")
+    longitude = form.get("Longitude")
+    address = form.get("Address")
+    label = form.get("Label")
+
+    resp = MessagingResponse()
+
+    # MEDIA שמירה+אינדוקס – ברקע; Twilio מקבל אישור מיד והסיכום נשלח כהודעה יזומה
+    if num_media > 0 and TWILIO_CAN_SEND:
+        BACKGROUND.submit(copy_current_request_context(_process_incoming_media), waid, num_media, body)
+        resp.message("📎 קיבלתי! שומר ומנתח את הקבצים – הסיכום יגיע בהודעה נפרדת.")
+        return str(resp)
+    # אין שולח מוגדר – מעבדים בתוך הבקשה ומחזירים את הסיכום ב-TwiML
+    if num_media > 0 and TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
+        saved_media = handle_incoming_media(waid, num_media, body)
+        if saved_media:
+            for ch in chunk_text(_media_summary(waid, saved_media)): resp.message(ch)
+            return str(resp)
+    elif num_media > 0:
+        logger.warning("Media received but TWILIO creds missing.")
+
+    # שמירת לינקים/מיקום כהמלצה
+    if body or (latitude and longitude):
+        store_recommendation_if_relevant(waid, body, latitude, longitude)
+
+    # GPT Router
+    nl = nl_route(body)
+    t = (nl or {}).get("type") or "general_chat"
+    p = (nl or {}).get("params") or {}
+
+    handler = ROUTE_HANDLERS.get(t, _act_general_chat)
+    return handler(waid, p, body, resp)
+
 # ───────────────────────────── Cron ─────────────────────────────
 def require_cron_secret():
     key = request.args.get("key")
     if key != CRON_SECRET:
         abort(403)
 
-def date_str(d: datetime) -> str:
-    return d.strftime("%Y-%m-%d")
+CRON_RUNS_KEEP_DAYS = 30
+
+def claim_cron_run(job: str, run_key: str) -> bool:
+    """True only for the first call with (job, run_key); retried cron hits for the same period get False."""
+    now = datetime.utcnow()
+    def _claim(db):
+        cur = db.execute("INSERT OR IGNORE INTO cron_runs (job, run_key, created_at) VALUES (?,?,?)",
+                         (job, run_key, now.isoformat()))
+        if cur.rowcount:
+            db.execute("DELETE FROM cron_runs WHERE created_at < ?",
+                       ((now - timedelta(days=CRON_RUNS_KEEP_DAYS)).isoformat(),))
+        return cur.rowcount == 1
+    return db_write(_claim)
 
 @app.route("/cron/daily", methods=["POST","GET"])
 def cron_daily():
@@ -1392,6 +1967,8 @@ def cron_daily():
     now = tz_now()
     tomorrow = now + timedelta(days=1)
     d_str = date_str(tomorrow)
+    if not claim_cron_run("daily", d_str):
+        return jsonify(ok=True, sent=0, duplicate=True)
     db = get_db()
     result = defaultdict(list)
     for fl in db.execute("SELECT * FROM flights WHERE depart_date=?", (d_str,)).fetchall():
@@ -1400,8 +1977,7 @@ def cron_daily():
     for ho in db.execute("SELECT * FROM hotels WHERE checkin_date=?", (d_str,)).fetchall():
         t = f"🏨 מחר צ'ק-אין: {ho['hotel_name'] or 'מלון'} בעיר {ho['city'] or ''}"
         result[ho["waid"]].append(t)
-    for waid, items in result.items():
-        send_whatsapp(waid, "תזכורת למחר:\n" + "\n".join(items))
+    send_whatsapp_many([(waid, "תזכורת למחר:\n" + "\n".join(items)) for waid, items in result.items()])
     return jsonify(ok=True, sent=len(result))
 
 @app.route("/cron/weekly", methods=["POST","GET"])
@@ -1409,39 +1985,55 @@ def cron_weekly():
     require_cron_secret()
     now = tz_now()
     until = now + timedelta(days=7)
+    iso_year, iso_week, _ = now.isocalendar()
+    if not claim_cron_run("weekly", f"{iso_year}-W{iso_week:02d}"):
+        return jsonify(ok=True, sent=0, duplicate=True)
     db = get_db()
-    waids = [r["waid"] for r in db.execute("SELECT DISTINCT waid FROM files").fetchall()]
-    total = 0
-    for waid in waids:
-        flights = db.execute(
-            "SELECT * FROM flights WHERE waid=? AND depart_date BETWEEN ? AND ? ORDER BY depart_date",
-            (waid, date_str(now), date_str(until))
-        ).fetchall()
-        hotels = db.execute(
-            "SELECT * FROM hotels WHERE waid=? AND checkin_date BETWEEN ? AND ? ORDER BY checkin_date",
-            (waid, date_str(now), date_str(until))
-        ).fetchall()
-        if not flights and not hotels:
-            continue
+    span = (date_str(now), date_str(until))
+    # שתי סריקות לכל המשתמשים (רק מי ששמר קבצים, כמו קודם) במקום שתי שאילתות לכל משתמש
+    flights_by_waid = {k: list(v) for k, v in groupby(db.execute(
+        "SELECT * FROM flights WHERE depart_date BETWEEN ? AND ? AND waid IN (SELECT waid FROM files) "
+        "ORDER BY waid, depart_date", span
+    ).fetchall(), key=lambda r: r["waid"])}
+    hotels_by_waid = {k: list(v) for k, v in groupby(db.execute(
+        "SELECT * FROM hotels WHERE checkin_date BETWEEN ? AND ? AND waid IN (SELECT waid FROM files) "
+        "ORDER BY waid, checkin_date", span
+    ).fetchall(), key=lambda r: r["waid"])}
+    outbox: List[Tuple[str, str]] = []
+    for waid in dict.fromkeys([*flights_by_waid, *hotels_by_waid]):
         lines = ["🗓️ השבוע הקרוב:"]
-        for fl in flights:
+        for fl in flights_by_waid.get(waid, []):
             lines.append(f"• ✈️ {fl['depart_date']} {fl['depart_time'] or ''} {fl['origin'] or ''}→{fl['dest'] or ''} {fl['flight_number'] or ''}".strip())
-        for ho in hotels:
+        for ho in hotels_by_waid.get(waid, []):
             lines.append(f"• 🏨 {ho['checkin_date']} צ'ק-אין: {ho['hotel_name'] or ''} ({ho['city'] or ''})")
-        send_whatsapp(waid, "\n".join(lines))
-        total += 1
-    return jsonify(ok=True, sent=total)
+        outbox.append((waid, "\n".join(lines)))
+    send_whatsapp_many(outbox)
+    return jsonify(ok=True, sent=len(outbox))
 
 @app.route("/cron/flightwatch", methods=["POST","GET"])
 def cron_flightwatch():
     require_cron_secret()
     db = get_db()
-    rows = db.execute("SELECT id, waid, flight_iata, flight_date FROM flight_watch ORDER BY id DESC").fetchall()
+    rows = db.execute("SELECT id, waid, flight_iata, flight_date, last_snapshot, snapshot_hash FROM flight_watch ORDER BY id DESC").fetchall()
+
+    # בקשה אחת לכל טיסה ייחודית (גם אם כמה משתמשים עוקבים אחריה), כולן במקביל
+    keys = list(dict.fromkeys((r["flight_iata"], r["flight_date"]) for r in rows))
+    futures = {EXECUTOR.submit(_fw_fetch_aviationstack, iata, fdate): (iata, fdate) for iata, fdate in keys}
+    results = {}
+    for fut in as_completed(futures):
+        try:
+            results[futures[fut]] = fut.result()
+        except Exception as e:
+            logger.exception("flightwatch fetch error for %s: %s", futures[fut][0], e)
+            results[futures[fut]] = {"error": str(e)}
+
     updated = 0; errors = 0
+    outbox: List[Tuple[str, str]] = []
+    hash_fills: List[tuple] = []; changes: List[tuple] = []
     for r in rows:
         iata = r["flight_iata"]; fdate = r["flight_date"]
         try:
-            res = _fw_fetch_aviationstack(iata, fdate)
+            res = results[(iata, fdate)]
             if res.get("error"):
                 errors += 1
                 continue
@@ -1449,20 +2041,28 @@ def cron_flightwatch():
             if not data:
                 continue
             snap = _fw_snapshot_from_aviationstack(data[0])
-            s_hash = _fw_snapshot_hash(snap)
-            row2 = db.execute("SELECT last_hash FROM flight_watch WHERE id=?", (r["id"],)).fetchone()
-            prev_hash = (row2["last_hash"] if row2 else None)
-            if s_hash != prev_hash:
-                recips = [r["waid"]] + [normalize_waid(x.replace("whatsapp:","").lstrip("+")) for x in NOTIFY_CC_WAIDS if x]
-                for rcpt in recips:
-                    send_whatsapp(rcpt, _fw_format_message(snap))
-                db.execute("UPDATE flight_watch SET last_snapshot=?, last_hash=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
-                           (json.dumps(snap, ensure_ascii=False), s_hash, r["id"]))
-                db.commit()
-                updated += 1
+            blob = _fw_snapshot_bytes(snap)
+            s_hash = _fw_snapshot_hash(blob)
+            if s_hash == r["snapshot_hash"]:
+                continue
+            if r["last_snapshot"] and orjson.loads(r["last_snapshot"]) == snap:
+                # שורה ישנה (last_hash טקסטואלי) לאותו מצב – ממלאים את snapshot_hash בלי לשלוח התראה
+                hash_fills.append((s_hash, r["id"]))
+                continue
+            changes.append((blob.decode(), s_hash, r["id"]))
+            outbox.append((r["waid"], _fw_format_message(snap)))
+            updated += 1
         except Exception as e:
             logger.exception("flightwatch error for %s: %s", iata, e)
             errors += 1
+
+    def _apply(db):
+        db.executemany("UPDATE flight_watch SET snapshot_hash=? WHERE id=?", hash_fills)
+        db.executemany("UPDATE flight_watch SET last_snapshot=?, snapshot_hash=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", changes)
+    if hash_fills or changes:
+        db_write(_apply)   # טרנזקציה אחת (fsync אחד) לכל הריצה
+    # ההתראות יוצאות רק אחרי שהעדכונים נשמרו, כולן יחד במקביל; כשל בכתיבה = אין שליחה כפולה בריצה הבאה
+    _fw_send_batch(outbox)
     return jsonify(ok=True, updated=updated, errors=errors, total=len(rows))
 
 # ───────────────────────────── Run ─────────────────────────────